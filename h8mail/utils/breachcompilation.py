@@ -1,39 +1,234 @@
 # -*- coding: utf-8 -*-
 from .colors import colors as c
+from .cache import default_cache_file
+from multiprocessing import Pool
+import json
+import mmap
 import os
 import re
-import stat
-from string import printable
+import signal
+import string
 
+# Number of lines checked to quickly tell a shard is not sorted
+SORT_SAMPLES = 64
+# Sorted state of checked shards, by path, with their size and modification time
+SORTED_SHARDS_FILE = "breachcompilation.json"
+SHARD_CHARS = string.ascii_lowercase + string.digits
 
-def breachcomp_check(targets, breachcomp_path):
+
+def shard_path(data_dir, target):
+    """
+    Returns the BreachCompilation data file holding target, resolved like query.sh does:
+    the first, second then third lowercased characters are followed as long as they are letters or digits,
+    and "symbols" files hold the others. Returns None when there is no such file.
+    """
     # https://gist.github.com/scottlinux/9a3b11257ac575e4f71de811322ce6b3
+    t = target.lower()
+    path = data_dir
+    for depth in range(3):
+        ch = t[depth : depth + 1]
+        if not ch or ch not in SHARD_CHARS:
+            path = os.path.join(path, "symbols")
+            break
+        path = os.path.join(path, ch)
+        if os.path.isfile(path):
+            return path
+    if os.path.isfile(path):
+        return path
+    return None
+
+
+def _line_at(mm, start):
+    end = mm.find(b"\n", start)
+    return mm[start:] if end == -1 else mm[start:end]
+
+
+def _lower_bound(mm, key):
+    """
+    Binary searches a sorted memory mapped shard for the offset of its first line not lower than key,
+    lines being compared lowercased
+    """
+    lo, hi = 0, len(mm)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start = mm.rfind(b"\n", lo, mid) + 1 or lo
+        end = mm.find(b"\n", start)
+        if end == -1:
+            end = len(mm)
+        if mm[start : min(end, start + len(key))].lower() < key:
+            lo = end + 1
+        else:
+            hi = start
+    return lo
+
+
+def _samples_sorted(mm):
+    """
+    Tells if evenly spaced lines of a shard are sorted once lowercased
+    """
+    last = b""
+    for i in range(SORT_SAMPLES):
+        pos = len(mm) * i // SORT_SAMPLES
+        start = mm.rfind(b"\n", 0, pos) + 1 if pos else 0
+        line = _line_at(mm, start).lower()
+        if line < last:
+            return False
+        last = line
+    return True
+
+
+def _is_sorted(mm):
+    """
+    Tells if every line of a shard is sorted once lowercased, in byte order.
+    Shards sorted with a locale collation, ignoring punctuation, may pass the sample check but are not
+    """
+    if not _samples_sorted(mm):
+        return False
+    last = b""
+    mm.seek(0)
+    for line in iter(mm.readline, b""):
+        line = line.rstrip(b"\r\n").lower()
+        if line < last:
+            return False
+        last = line
+    return True
+
+
+def sorted_shards_file():
+    return os.path.join(os.path.dirname(default_cache_file()), SORTED_SHARDS_FILE)
+
+
+def load_sorted_shards():
+    """
+    Returns the recorded sorted state of shards, by path, as [size, mtime, sorted]
+    """
     try:
-        import subprocess
+        with open(sorted_shards_file()) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
 
-        query_bin = os.path.join(breachcomp_path, "query.sh")
-        st = os.stat(query_bin)
-        os.chmod(query_bin, st.st_mode | stat.S_IEXEC)
+def save_sorted_shards(shards):
+    path = sorted_shards_file()
+    try:
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        with open(path + ".tmp", "w") as fp:
+            json.dump(shards, fp)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        c.bad_news("Could not record sorted BreachCompilation files")
+        print(e)
+
+
+def shard_lookup(shard, targets, known_sorted=None):
+    """
+    Looks up every target in a BreachCompilation shard.
+    Matches lines starting with a target regardless of case, like query.sh grep does.
+    Sorted shards are binary searched, others are scanned once for all targets.
+    Every line is checked to tell if the shard is sorted, unless known_sorted is given from a previous check.
+    Returns dict of target, list of matching raw lines, and whether the shard is sorted (None on errors).
+    """
+    found = {}
+    is_sorted = None
+    try:
+        with open(shard, "rb") as fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                return found, True
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                is_sorted = known_sorted
+                if is_sorted is None:
+                    is_sorted = _is_sorted(mm)
+                if is_sorted:
+                    for t in dict.fromkeys(targets):
+                        key = t.encode("utf-8").lower()
+                        pos = _lower_bound(mm, key)
+                        while pos < len(mm):
+                            line = _line_at(mm, pos)
+                            if not line.lower().startswith(key):
+                                break
+                            found.setdefault(t, []).append(line.rstrip(b"\r"))
+                            pos += len(line) + 1
+                else:
+                    keys = {}
+                    for t in dict.fromkeys(targets):
+                        keys.setdefault(t.encode("utf-8").lower(), []).append(t)
+                    regex = re.compile(
+                        rb"^(?:"
+                        + b"|".join(re.escape(k) for k in sorted(keys, key=len, reverse=True))
+                        + rb").*$",
+                        re.IGNORECASE | re.MULTILINE,
+                    )
+                    for m in regex.finditer(mm):
+                        line = m.group().rstrip(b"\r")
+                        for key, same_targets in keys.items():
+                            if line[: len(key)].lower() == key:
+                                for t in same_targets:
+                                    found.setdefault(t, []).append(line)
+            finally:
+                mm.close()
+    except Exception as e:
+        c.bad_news(f"Something went wrong looking up {shard}")
+        print(e)
+    return found, is_sorted
+
+
+def breachcomp_check(targets, breachcomp_path):
+    """
+    Looks up targets in the BreachCompilation data folder, without query.sh.
+    Targets are batched by data file, and every data file is searched by a separate worker.
+    Whether data files are sorted is checked once and recorded in the user cache folder, until they change.
+    """
+    try:
+        data_dir = os.path.join(breachcomp_path, "data")
+        if not os.path.isdir(data_dir):
+            c.bad_news(f"Could not find BreachCompilation data folder in {breachcomp_path}")
+            return targets
+        shards = {}
         for t in targets:
             c.info_news(f"Looking up {t.target} in BreachCompilation")
-            procfd = subprocess.run([query_bin, t.target], stdout=subprocess.PIPE)
-            try:
-                output = procfd.stdout.decode("cp437")
-            except Exception as e:
-                c.bad_news(f"Could not decode bytes for {t.target} results")
-                output = procfd.stdout
-                # print(output[:85], "[...]")
-                print(output)
-                continue
-            if len(output) != 0:
-                split_output = output.split("\n")
-                for line in split_output:
-                    if ":" in line:
-                        t.pwned += 1
-                        t.data.append(("BC_PASS", re.split("[;:]",line)[-1]))
-                        c.good_news(
-                            f"Found BreachedCompilation entry {line}"
-                        )
+            shard = shard_path(data_dir, t.target)
+            if shard is not None:
+                shards.setdefault(shard, []).append(t.target)
+        sorted_shards = load_sorted_shards()
+        stats = {}
+        tasks = []
+        for shard, shard_targets in shards.items():
+            st = os.stat(shard)
+            stats[shard] = [st.st_size, st.st_mtime]
+            known = sorted_shards.get(shard)
+            known_sorted = known[2] if known is not None and known[:2] == stats[shard] else None
+            tasks.append((shard, shard_targets, known_sorted))
+        original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        pool = Pool()
+        signal.signal(signal.SIGINT, original_sigint_handler)
+        try:
+            results = pool.starmap(shard_lookup, tasks)
+        except KeyboardInterrupt:
+            c.bad_news("Caught KeyboardInterrupt, terminating workers")
+            pool.terminate()
+            pool.join()
+            return targets
+        else:
+            pool.close()
+        pool.join()
+        found = {}
+        checked = False
+        for (shard, _, known_sorted), (r, is_sorted) in zip(tasks, results):
+            found.update(r)
+            if known_sorted is None and is_sorted is not None:
+                sorted_shards[shard] = stats[shard] + [is_sorted]
+                checked = True
+        if checked:
+            save_sorted_shards(sorted_shards)
+        for t in targets:
+            for line in found.get(t.target, []):
+                line = line.decode("cp437")
+                if ":" in line:
+                    t.pwned += 1
+                    t.data.append(("BC_PASS", re.split("[;:]", line)[-1]))
+                    c.good_news(f"Found BreachedCompilation entry {line}")
         return targets
     except Exception as e:
         c.bad_news("Breach compilation")
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+from .colors import colors as c
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from concurrent.futures import Future
+from threading import Lock
+import json
+import os
+import sqlite3
+import time
+
+# Seconds a found answer is reused for, per provider
+DEFAULT_TTLS = {
+    "hibp": 86400,
+    "emailrep": 86400,
+    "scylla": 86400,
+    "hunterio": 7 * 86400,
+    "snusbase": 7 * 86400,
+    "leaklookup": 7 * 86400,
+    "weleakinfo": 7 * 86400,
+    "dehashed": 7 * 86400,
+    "breachdirectory": 7 * 86400,
+}
+DEFAULT_TTL = 86400
+# Seconds a not found answer, 404 or empty body, is reused for
+NEGATIVE_TTL = 3600
+CACHE_SIZE = 64 << 20
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+EMPTY_BODIES = (b"", b"[]", b"{}", b"null")
+# Query types searching emails or domains, whose terms are case insensitive.
+# Public lookups of leaklookup and weleakinfo only search emails
+CASELESS_QUERIES = {"email", "domain", "breachedaccount", "pasteaccount", "email-count", "domain-search", "public"}
+
+_cache = None
+# Requests coalesced for the run, by key
+_coalesced = {}
+_coalesced_lock = Lock()
+
+
+def default_cache_file():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "h8mail", "responses.sqlite")
+
+
+def cache_key(provider, query_type, term):
+    """
+    Returns the key of a lookup. Terms are lowercased for email and domain lookups only,
+    as passwords, usernames and hashes are case sensitive
+    """
+    if query_type in CASELESS_QUERIES:
+        term = term.lower()
+    return (provider, query_type, term)
+
+
+def private_dir(path):
+    """
+    Creates directory path if missing, and makes it accessible by the current user only
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    os.chmod(path, 0o700)
+
+
+def private_file(path):
+    """
+    Creates file path if missing, and makes it readable and writable by the current user only.
+    Cached answers hold breach data such as cleartext passwords
+    """
+    os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600))
+    os.chmod(path, 0o600)
+
+
+def parse_duration(value):
+    """
+    Returns seconds from a config duration, either a number of seconds or a number followed by a unit such as "12h".
+    Units are s, m, h and d
+    """
+    value = value.strip()
+    if value[-1:] in DURATION_UNITS:
+        return float(value[:-1]) * DURATION_UNITS[value[-1]]
+    return float(value)
+
+
+class response_cache:
+    """
+    SQLite cache of provider responses, keyed by provider, query type and searched term.
+    Entries expire after the TTL of their provider, or the negative TTL for not found answers.
+    Least recently used entries are evicted once the cached bodies grow over max_size bytes.
+    With refresh, cached entries are ignored but new responses are still stored.
+    """
+
+    def __init__(self, path, ttls=None, negative_ttl=NEGATIVE_TTL, max_size=CACHE_SIZE, refresh=False):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), mode=0o700, exist_ok=True)
+        private_file(path)
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.refresh = refresh
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                provider TEXT, query_type TEXT, term TEXT,
+                status INTEGER, url TEXT, encoding TEXT, headers TEXT, body BLOB,
+                expires REAL, accessed REAL, size INTEGER,
+                PRIMARY KEY (provider, query_type, term))"""
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.db.commit()
+
+    def get(self, provider, query_type, term):
+        """
+        Returns the cached requests Response of this lookup, or None when missing or expired
+        """
+        if self.refresh:
+            return None
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT status, url, encoding, headers, body FROM responses "
+                "WHERE provider = ? AND query_type = ? AND term = ? AND expires > ?",
+                cache_key(provider, query_type, term) + (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            self.db.execute(
+                "UPDATE responses SET accessed = ? WHERE provider = ? AND query_type = ? AND term = ?",
+                (now,) + cache_key(provider, query_type, term),
+            )
+            self.db.commit()
+        response = Response()
+        response.status_code, response.url, response.encoding = row[0], row[1], row[2]
+        response.headers = CaseInsensitiveDict(json.loads(row[3]))
+        response._content = row[4]
+        return response
+
+    def put(self, provider, query_type, term, response):
+        """
+        Stores a response. Only successful and not found answers are cached.
+        The query string of the URL is left out, as some providers take API keys there
+        """
+        body = response.content
+        if response.status_code == 404 or (
+            response.status_code == 200 and body.strip() in EMPTY_BODIES
+        ):
+            ttl = self.negative_ttl
+        elif 200 <= response.status_code < 300:
+            ttl = self.ttls.get(provider, DEFAULT_TTL)
+        else:
+            return
+        if ttl <= 0:
+            return
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                cache_key(provider, query_type, term)
+                + (
+                    response.status_code,
+                    response.url.split("?")[0],
+                    response.encoding,
+                    json.dumps(dict(response.headers)),
+                    body,
+                    now + ttl,
+                    now,
+                    len(body),
+                ),
+            )
+            self.evict()
+            self.db.commit()
+
+    def evict(self):
+        """
+        Deletes expired entries, then least recently used entries until cached bodies fit in max_size bytes
+        """
+        self.db.execute("DELETE FROM responses WHERE expires <= ?", (time.time(),))
+        (total,) = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+        if total <= self.max_size:
+            return
+        evicted = []
+        for key in self.db.execute(
+            "SELECT provider, query_type, term, size FROM responses ORDER BY accessed"
+        ):
+            if total <= self.max_size:
+                break
+            evicted.append(key[:3])
+            total -= key[3]
+        self.db.executemany(
+            "DELETE FROM responses WHERE provider = ? AND query_type = ? AND term = ?", evicted
+        )
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def configure_cache(user_args, api_keys):
+    """
+    Opens the response cache used by target lookups, unless --no-cache is set, and forgets coalesced requests.
+    Reads the cache_file, cache_size (MB), cache_negative_ttl and cache_ttl_<provider> configuration keys
+    """
+    global _cache
+    with _coalesced_lock:
+        _coalesced.clear()
+    if _cache is not None:
+        _cache.close()
+        _cache = None
+    if user_args.no_cache:
+        return
+    config = {}
+    if api_keys is not None:
+        config = {k: api_keys[k] for k in api_keys if k.startswith("cache_") and len(api_keys[k]) != 0}
+    try:
+        ttls = {
+            k[len("cache_ttl_") :]: parse_duration(v)
+            for k, v in config.items()
+            if k.startswith("cache_ttl_")
+        }
+        path = config.get("cache_file")
+        if path is None:
+            path = default_cache_file()
+            # Directory shared with the intelx.io file store, made private for caches created by older versions
+            private_dir(os.path.dirname(path))
+        _cache = response_cache(
+            path,
+            ttls,
+            parse_duration(config.get("cache_negative_ttl", str(NEGATIVE_TTL))),
+            int(float(config.get("cache_size", CACHE_SIZE >> 20)) * (1 << 20)),
+            user_args.refresh_cache,
+        )
+    except Exception as e:
+        c.bad_news("Could not open response cache, lookups will not be cached")
+        print(e)
+
+
+def cached_response(provider, query_type, term):
+    if _cache is None:
+        return None
+    try:
+        return _cache.get(provider, query_type, term)
+    except sqlite3.Error as e:
+        c.bad_news(f"Response cache error for {provider} {term}")
+        print(e)
+
+
+def cache_response(provider, query_type, term, response):
+    if _cache is None:
+        return
+    try:
+        _cache.put(provider, query_type, term, response)
+    except sqlite3.Error as e:
+        c.bad_news(f"Response cache error for {provider} {term}")
+        print(e)
+
+
+def coalesced_request(key, send):
+    """
+    Calls send() once per key for the run and returns its response, or raises its error.
+    Callers of a key being sent wait for it instead of sending it again
+    """
+    with _coalesced_lock:
+        future = _coalesced.get(key)
+        owner = future is None
+        if owner:
+            future = _coalesced[key] = Future()
+    if owner:
+        try:
+            future.set_result(send())
+        except Exception as e:
+            future.set_exception(e)
+    return future.result()
@@ -7,40 +7,37 @@ import re
 def chase(target, user_args):
     """
     Takes the current target & returns adequate chase list
-    to add to the current target list
+    to add to the current target list. Chase depth and deduplication are handled by target_factory()
     """
     new_targets = []
-    chase_counter = 0
     if user_args.debug:
         print(c.fg.red, "\nCHASING DEBUG-----------")
-        print(f"Hunting targets from {target.target}")
-        print(f"Recursive Chase Stop is at {user_args.chase_limit}" + c.reset)
-    if user_args.chase_limit > 0:
-        for d in target.data:
-            if len(d) != 2:
-                continue
+        print(f"Hunting targets from {target.target}" + c.reset)
+    for d in target.data:
+        if d.content is not None:
+            continue
 
-            if user_args.power_chase:
-                if "RELATED" in d[0] or "EMAIL" in d[0]:
-                    c.good_news(
-                        "Chasing {new_target} as new target".format(new_target=d[1])
-                    )
-                    new_targets.append(d[1])
-                else: # in case there is an email as a username
-                    e = re.findall(r"[\w\.-]+@[\w\.-]+", d[1])
-                    if e:
-                        for email in e:
-                            c.good_news(
-                                "Chasing {new_target} as new target (found as pattern)".format(
-                                    new_target=d[1]
-                                )
+        if user_args.power_chase:
+            if "RELATED" in d.label or "EMAIL" in d.label:
+                c.good_news(
+                    "Chasing {new_target} as new target".format(new_target=d.value)
+                )
+                new_targets.append(d.value)
+            else: # in case there is an email as a username
+                e = re.findall(r"[\w\.-]+@[\w\.-]+", str(d.value))
+                if e:
+                    for email in e:
+                        c.good_news(
+                            "Chasing {new_target} as new target (found as pattern)".format(
+                                new_target=email
                             )
-                            new_targets.append(d[1])
+                        )
+                        new_targets.append(email)
 
-            else:
-                if "HUNTER_RELATED" in d[0]:
-                    c.good_news(
-                        "Chasing {new_target} as new target".format(new_target=d[1])
-                    )
-                    new_targets.append(d[1])
+        else:
+            if "HUNTER_RELATED" in d.label:
+                c.good_news(
+                    "Chasing {new_target} as new target".format(new_target=d.value)
+                )
+                new_targets.append(d.value)
     return new_targets
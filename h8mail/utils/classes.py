@@ -1,6 +1,8 @@
 #!/usr/bin/env python
-from .intelx import intelx as i
-from time import sleep
+from .ratelimit import concurrency_limit, hold, request_slot, wait_turn
+from .retry import retry_delay
+from .cache import cache_key, cached_response, cache_response, coalesced_request
+from .sessions import http_request
 from .colors import colors as c
 import requests
 import json
@@ -10,32 +12,128 @@ import platform
 from .version import __version__
 
 
+def accepted(valid, response):
+    """
+    Tells if response is a usable answer according to the valid check of its provider, if any.
+    Checks failing to read the response reject it
+    """
+    if valid is None:
+        return True
+    try:
+        return bool(valid(response))
+    except Exception:
+        return False
+
+
+def leaklookup_answered(response):
+    """
+    Leak-Lookup reports quota and key errors in successful responses, with error set to "true"
+    """
+    return response.json()["error"] == "false"
+
+
+def weleakinfo_answered(response):
+    """
+    WeLeakInfo reports errors in successful responses, with Success set to false
+    """
+    return response.json()["Success"] is not False
+
+
 class local_breach_target:
     """
 	Class is called when performing local file search.
 	This class is meant to store found data, to be later appended to the existing target objects.
     local_to_targets() tranforms to target object
-	Used by both cleartext and gzip search
+	Used by both cleartext and gzip search. Member is the tar archive member name, for tar.gz breaches
 	"""
 
-    def __init__(self, target_data, fp, ln, content):
+    def __init__(self, target_data, fp, ln, content, member=None):
         self.target = target_data
         self.filepath = fp
         self.line = ln
         self.content = content
+        self.member = member
 
     def dump(self):
         print(f"Email: {self.target}")
         print(f"Path: {self.filepath}")
+        if self.member is not None:
+            print(f"Member: {self.member}")
         print(f"Line: {self.line}")
         print(f"Content: {self.content}")
         print()
 
 
+class breach_record:
+    """
+    Single piece of found data: its type label, such as "HIBP3", and value.
+    Local search records also keep the original matching content.
+    Labels are interned, as a few of them are shared by every record.
+    Records read like the (label, value) or (label, value, content) tuples they replace
+    """
+
+    __slots__ = ("label", "value", "content")
+
+    def __init__(self, label, value, content=None):
+        self.label = sys.intern(label)
+        self.value = value
+        self.content = content
+
+    def __len__(self):
+        return 2 if self.content is None else 3
+
+    def __getitem__(self, i):
+        return (self.label, self.value, self.content)[: len(self)][i]
+
+    def __iter__(self):
+        return iter((self.label, self.value, self.content)[: len(self)])
+
+
+class breach_data:
+    """
+    Found data of a target: breach_records in the order they were found, with a hash index of their values.
+    Tuples appended are stored as breach_records
+    """
+
+    __slots__ = ("records", "values")
+
+    def __init__(self):
+        self.records = []
+        self.values = set()
+
+    def append(self, record):
+        if not isinstance(record, breach_record):
+            record = breach_record(*record)
+        self.records.append(record)
+        try:
+            self.values.add(record.value)
+        except TypeError:  # Unhashable values are not deduplicated
+            pass
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def has_value(self, value):
+        try:
+            return value in self.values
+        except TypeError:
+            return False
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __getitem__(self, i):
+        return self.records[i]
+
+
 class target:
     """
 	Main class used to create and follow breach data.
-	Found data is stored in self.data. Each method increments self.pwned when data is found.
+	Found data is stored in self.data, a breach_data. Each method increments self.pwned when data is found.
 	"""
 
     def __init__(self, target_data, debug=False):
@@ -48,7 +146,7 @@ class target:
         }
         self.target = target_data
         self.pwned = 0
-        self.data = [()]
+        self.data = breach_data()
         self.debug = debug
         if debug:
             print(
@@ -58,11 +156,7 @@ class target:
             )
 
     def not_exists(self, pattern):
-        for d in self.data:
-            if len(d) >= 2:
-                if d[1] == pattern:
-                    return False
-        return True
+        return not self.data.has_value(pattern)
 
     def make_request(
         self,
@@ -74,50 +168,120 @@ class target:
         params=None,
         verify=True,
         auth=None,
+        headers=None,
+        provider=None,
+        rate_key="",
+        query_type=None,
+        term=None,
+        coalesce=False,
+        valid=None,
     ):
-        try:
-            response = requests.request(
-                url=url,
-                headers=self.headers,
-                method=meth,
-                timeout=timeout,
-                allow_redirects=redirs,
-                data=data,
-                params=params,
-                verify=verify,
-                auth=auth,
-            )
-            # response = requests.request(url="http://127.0.0.1:8000", headers=self.headers, method=meth, timeout=timeout, allow_redirects=redirs, data=data, params=params)
-            if self.debug:
-                c.debug_news("DEBUG: Sent the following---------------------")
-                print(self.headers)
-                print(url, meth, data, params)
-                c.debug_news("DEBUG: Received the following---------------------")
-                c.debug_news(response.url)
-                c.debug_news("DEBUG: RESPONSE HEADER---------------------")
-                print(
-                    "\n".join(
-                        f"{k}: {v}" for k, v in response.headers.items()
+        """
+        Sends a request with the target headers, updated with the headers of this request only.
+        Waits for the rate limit of provider and rate_key first.
+        Requests to a provider are retried with backoff when throttled, failing with 5xx or not reaching the service.
+        Errors other than responses are raised once retries are exhausted.
+        When query_type is set, the response is cached under provider, query_type and term (the target by default),
+        and a cached response is returned without sending the request.
+        valid is the check of providers reporting errors in successful responses, rejected responses are not cached.
+        With coalesce, the request is sent once per run for the same key, concurrent callers sharing its response
+        """
+        if query_type is not None:
+            if term is None:
+                term = self.target
+            if coalesce:
+                return coalesced_request(
+                    cache_key(provider, query_type, term),
+                    lambda: self.make_request(
+                        url, meth, timeout, redirs, data, params, verify, auth, headers,
+                        provider, rate_key, query_type, term, valid=valid,
+                    ),
+                )
+            response = cached_response(provider, query_type, term)
+            if response is not None:
+                if self.debug:
+                    c.debug_news(
+                        f"DEBUG: Using cached {provider} {query_type} response for {term}"
+                    )
+                return response
+        request_headers = dict(self.headers)
+        if headers is not None:
+            request_headers.update(headers)
+        attempt = 0
+        while True:
+            if provider is not None:
+                wait_turn(provider, rate_key)
+            try:
+                with request_slot(provider):
+                    response = http_request(
+                        url=url,
+                        headers=request_headers,
+                        method=meth,
+                        timeout=timeout,
+                        allow_redirects=redirs,
+                        data=data,
+                        params=params,
+                        verify=verify,
+                        auth=auth,
                     )
+            except Exception as ex:
+                delay = None
+                if provider is not None and isinstance(
+                    ex, (requests.ConnectionError, requests.Timeout)
+                ):
+                    delay = retry_delay(provider, attempt)
+                if delay is None:
+                    c.bad_news("Request could not be made for " + self.target)
+                    print(url)
+                    print(ex)
+                    raise
+                c.info_news(
+                    f"Request to {provider} failed for {self.target}, retrying in {delay:.1f}s"
                 )
-                c.debug_news("DEBUG: RESPONSE BODY---------------------")
-                print(response.content)
-                # print(response)
-        except Exception as ex:
-            c.bad_news("Request could not be made for " + self.target)
-            print(url)
-            print(ex)
-            print(response)
+            else:
+                # response = requests.request(url="http://127.0.0.1:8000", headers=self.headers, method=meth, timeout=timeout, allow_redirects=redirs, data=data, params=params)
+                if self.debug:
+                    c.debug_news("DEBUG: Sent the following---------------------")
+                    print(request_headers)
+                    print(url, meth, data, params)
+                    c.debug_news("DEBUG: Received the following---------------------")
+                    c.debug_news(response.url)
+                    c.debug_news("DEBUG: RESPONSE HEADER---------------------")
+                    print(
+                        "\n".join(
+                            f"{k}: {v}" for k, v in response.headers.items()
+                        )
+                    )
+                    c.debug_news("DEBUG: RESPONSE BODY---------------------")
+                    print(response.content)
+                    # print(response)
+                if provider is None:
+                    break
+                delay = retry_delay(provider, attempt, response)
+                if delay is None:
+                    break
+                c.info_news(
+                    f"{provider} answered {response.status_code} for {self.target}, retrying in {delay:.1f}s"
+                )
+            # Every request to this provider and key waits, not only this one
+            hold(provider, rate_key, delay)
+            attempt += 1
+        if query_type is not None and accepted(valid, response):
+            cache_response(provider, query_type, term, response)
         return response
 
     # New HIBP API
     def get_hibp3(self, api_key):
         try:
             c.info_news("[" + self.target + "]>[hibp]")
-            sleep(1.3)
             url = f"https://haveibeenpwned.com/api/v3/breachedaccount/{self.target}"
-            self.headers.update({"hibp-api-key": api_key})
-            response = self.make_request(url)
+            response = self.make_request(
+                url,
+                headers={"hibp-api-key": api_key},
+                provider="hibp",
+                rate_key=api_key,
+                query_type="breachedaccount",
+            )
             if response.status_code not in [200, 404]:
                 c.bad_news("Could not contact HIBP v3 for " + self.target)
                 print(response.status_code)
@@ -132,11 +296,10 @@ class target:
 
                 c.good_news(
                     "Found {num} breaches for {target} using HIBP v3".format(
-                        num=len(self.data) - 1, target=self.target
+                        num=len(data), target=self.target
                     )
                 )
-                self.get_hibp3_pastes()
-                self.headers.popitem()
+                self.get_hibp3_pastes(api_key)
             elif response.status_code == 404:
                 c.info_news(
                     f"No breaches found for {self.target} using HIBP v3"
@@ -152,13 +315,18 @@ class target:
             print(e)
 
     # New HIBP API
-    def get_hibp3_pastes(self):
+    def get_hibp3_pastes(self, api_key):
         try:
             c.info_news("[" + self.target + "]>[hibp-paste]")
-            sleep(1.3)
             url = f"https://haveibeenpwned.com/api/v3/pasteaccount/{self.target}"
 
-            response = self.make_request(url)
+            response = self.make_request(
+                url,
+                headers={"hibp-api-key": api_key},
+                provider="hibp",
+                rate_key=api_key,
+                query_type="pasteaccount",
+            )
             if response.status_code not in [200, 404]:
                 c.bad_news("Could not contact HIBP PASTE for " + self.target)
                 print(response.status_code)
@@ -198,28 +366,23 @@ class target:
 
     def get_intelx(self, api_keys):
         try:
-            intel_files = []
-            intelx = i(key=api_keys["intelx_key"], ua="h8mail-v.{h8ver}-OSINT-and-Education-Tool (PythonVersion={pyver}; Platform={platfrm})".format(
-                h8ver=__version__,
-                pyver=sys.version.split(" ")[0],
-                platfrm=platform.platform().split("-")[0],
-            ))
-            from .intelx_helpers import intelx_getsearch
-            from .localsearch import local_search
-            from os import remove, fspath
+            from .intelx_helpers import get_intelx_client, intelx_getsearch
+            from .matcher import target_matcher
+            from concurrent.futures import ThreadPoolExecutor
 
+            client = get_intelx_client(api_keys["intelx_key"], self.headers["User-Agent"])
             maxfile = 10
-            if api_keys["intelx_maxfile"]:
+            if api_keys.get("intelx_maxfile"):
                 maxfile = int(api_keys["intelx_maxfile"])
-            search = intelx_getsearch(self.target, intelx, maxfile)
+            cap = client.capabilities()
+            search = intelx_getsearch(self.target, client, maxfile)
             if self.debug:
                 import json
 
                 print(json.dumps(search, indent=4))
 
+            records = []
             for record in search["records"]:
-                filename = record["systemid"].strip() + ".txt"
-                intel_files.append(filename)
                 if record["media"] != 24:
                     c.info_news(
                         "Skipping {name}, not text ({type})".format(
@@ -227,65 +390,108 @@ class target:
                         )
                     )
                     continue
-                c.good_news(
+                records.append(record)
+            if len(records) == 0:
+                return
+            # Records are downloaded and searched concurrently, results are added in search order
+            matcher = target_matcher([self.target])
+            workers = min(len(records), concurrency_limit("intelx") or len(records))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(self.intelx_file, client.api, cap, record, matcher)
+                    for record in records
+                ]
+                for f in futures:
+                    for d in f.result():
+                        self.pwned += 1
+                        self.data.append(d)
+
+        except Exception as ex:
+            c.bad_news("intelx.io error: " + self.target)
+            print(ex)
+
+    def intelx_file(self, intelx, cap, record, matcher):
+        """
+        Searches an intelx.io file for the target, taking one file read credit of the API key when downloading it.
+        Returns the found data.
+        With the file store, files are downloaded once and scanned once for every target of the run.
+        Otherwise they are searched while they download, and only written to disk when debugging
+        """
+        from .intelx_helpers import intelx_store_enabled, search_stored_file, take_file_credit
+        from .matcher import scan_blocks, tee_blocks
+
+        def download():
+            if not take_file_credit(intelx, cap):
+                c.bad_news(
                     "["
                     + self.target
-                    + "]>[intelx.io] Fetching "
+                    + "]>[intelx.io] No file read credit left, skipping "
                     + record["name"]
-                    + " as file "
-                    + filename
-                    + " ("
-                    + "{:,.0f}".format(record["size"] / float(1 << 20))
-                    + " MB)"
                 )
-                intelx.FILE_READ(record["systemid"], 0, record["bucket"], filename)
-                found_list = local_search([filename], [self.target])
-                for f in found_list:
-                    self.pwned += 1
-                    self.data.append(
+                return None
+            c.good_news(
+                "["
+                + self.target
+                + "]>[intelx.io] Fetching "
+                + record["name"]
+                + " ("
+                + "{:,.0f}".format(record["size"] / float(1 << 20))
+                + " MB)"
+            )
+            return intelx.FILE_STREAM(record["systemid"], 0, record["bucket"])
+
+        found = []
+        try:
+            with request_slot("intelx"):
+                if intelx_store_enabled():
+                    lines = search_stored_file(record["systemid"], self.target, download)
+                    if lines is None:
+                        return found
+                else:
+                    blocks = download()
+                    if blocks is None:
+                        return found
+                    if self.debug:
+                        filename = record["systemid"].strip() + ".txt"
+                        c.info_news(
+                            "["
+                            + self.target
+                            + f"]>[intelx.io] [DEBUG] Keeping {filename}"
+                        )
+                        blocks = tee_blocks(blocks, filename)
+                    lines = ((cnt, line) for cnt, line, _ in scan_blocks(blocks, matcher))
+                for cnt, line in lines:
+                    found.append(
                         (
                             "INTELX.IO",
                             "{name} | Line: {line} - {content}".format(
                                 name=record["name"].strip(),
-                                line=f.line,
-                                content=" ".join(f.content.split()),
+                                line=cnt,
+                                content=" ".join(str(line, "cp437").split()),
                             ),
                         )
                     )
-                # print(contents) # Contains search data
-            for file in intel_files:
-                try:
-                    if self.debug:
-                        c.info_news(
-                            "["
-                            + self.target
-                            + f"]>[intelx.io] [DEBUG] Keeping {file}"
-                        )
-                    else:
-                        c.info_news(
-                            "["
-                            + self.target
-                            + f"]>[intelx.io] Removing {file}"
-                        )
-                        remove(file)
-                except Exception as ex:
-                    c.bad_news("intelx.io cleanup error: " + self.target)
-                    print(ex)
-
         except Exception as ex:
-            c.bad_news("intelx.io error: " + self.target)
+            c.bad_news(f"intelx.io error with {record['name']} for {self.target}")
             print(ex)
+        return found
 
     def get_emailrepio(self, api_key=""):
         try:
-            sleep(0.5)
+            headers = {}
             if len(api_key) != 0:
-                self.headers.update({"Key": api_key})
+                headers["Key"] = api_key
                 c.info_news("[" + self.target + "]>[emailrep.io+key]")
             else:
                 c.info_news("[" + self.target + "]>[emailrep.io]")
             url = f"https://emailrep.io/{self.target}"
-            response = self.make_request(url)
+            response = self.make_request(
+                url,
+                headers=headers,
+                provider="emailrep",
+                rate_key=api_key,
+                query_type="email",
+            )
             if response.status_code not in [200, 404, 429]:
                 c.bad_news("Could not contact emailrep for " + self.target)
                 print(response.status_code)
@@ -362,8 +568,6 @@ class target:
                         code=response.status_code, target=self.target
                     )
                 )
-            if len(api_key) != 0:
-                self.headers.popitem()
         except Exception as ex:
             c.bad_news("emailrep.io error: " + self.target)
             print(ex)
@@ -371,8 +575,6 @@ class target:
     def get_scylla(self, user_query="email"):
         try:
             c.info_news("[" + self.target + "]>[scylla.so]")
-            sleep(0.5)
-            self.headers.update({"Accept": "application/json"})
             if user_query == "email":
                 uri_scylla = 'email: "' + self.target + '"'
             elif user_query == "password":
@@ -393,9 +595,11 @@ class target:
             response = self.make_request(
                 url,
                 verify=False,
+                headers={"Accept": "application/json"},
+                provider="scylla",
+                query_type=user_query,
                 # auth=requests.auth.HTTPBasicAuth("sammy", "BasicPassword!"),
             )
-            self.headers.popitem()
 
             if response.status_code not in [200, 404]:
                 c.bad_news("Could not contact scylla.so for " + self.target)
@@ -447,7 +651,13 @@ class target:
             c.info_news("[" + self.target + "]>[hunter.io public]")
             target_domain = self.target.split("@")[1]
             url = f"https://api.hunter.io/v2/email-count?domain={target_domain}"
-            req = self.make_request(url)
+            req = self.make_request(
+                url,
+                provider="hunterio",
+                query_type="email-count",
+                term=target_domain,
+                coalesce=True,
+            )
             response = req.json()
             if response["data"]["total"] != 0:
                 self.data.append(("HUNTER_PUB", response["data"]["total"]))
@@ -465,7 +675,14 @@ class target:
             c.info_news("[" + self.target + "]>[hunter.io private]")
             target_domain = self.target.split("@")[1]
             url = f"https://api.hunter.io/v2/domain-search?domain={target_domain}&api_key={api_key}"
-            req = self.make_request(url)
+            req = self.make_request(
+                url,
+                provider="hunterio",
+                rate_key=api_key,
+                query_type="domain-search",
+                term=target_domain,
+                coalesce=True,
+            )
             response = req.json()
             b_counter = 0
             for e in response["data"]["emails"]:
@@ -495,10 +712,16 @@ class target:
                 return
             c.info_news("[" + self.target + "]>[snusbase]")
             url = api_url
-            self.headers.update({"Authorization": api_key})
             payload = {"type": user_query, "term": self.target}
-            req = self.make_request(url, meth="POST", data=payload)
-            self.headers.popitem()
+            req = self.make_request(
+                url,
+                meth="POST",
+                data=payload,
+                headers={"Authorization": api_key},
+                provider="snusbase",
+                rate_key=api_key,
+                query_type=user_query,
+            )
             response = req.json()
             c.good_news(
                 "Found {num} entries for {target} using Snusbase".format(
@@ -544,7 +767,16 @@ class target:
             c.info_news("[" + self.target + "]>[leaklookup public]")
             url = "https://leak-lookup.com/api/search"
             payload = {"key": api_key, "type": "email_address", "query": self.target}
-            req = self.make_request(url, meth="POST", data=payload, timeout=20)
+            req = self.make_request(
+                url,
+                meth="POST",
+                data=payload,
+                timeout=20,
+                provider="leaklookup",
+                rate_key=api_key,
+                query_type="public",
+                valid=leaklookup_answered,
+            )
             response = req.json()
             if "false" in response["error"] and len(response["message"]) != 0:
                 c.good_news(
@@ -578,7 +810,16 @@ class target:
             c.info_news("[" + self.target + "]>[leaklookup private]")
             url = "https://leak-lookup.com/api/search"
             payload = {"key": api_key, "type": user_query, "query": self.target}
-            req = self.make_request(url, meth="POST", data=payload, timeout=60)
+            req = self.make_request(
+                url,
+                meth="POST",
+                data=payload,
+                timeout=60,
+                provider="leaklookup",
+                rate_key=api_key,
+                query_type=user_query,
+                valid=leaklookup_answered,
+            )
             response = req.json()
             if "false" in response["error"] and len(response["message"]) != 0:
                 b_counter = 0
@@ -654,15 +895,24 @@ class target:
     def get_weleakinfo_priv(self, api_key, user_query):
         try:
             c.info_news("[" + self.target + "]>[weleakinfo priv]")
-            sleep(0.4)
             url = "https://api.weleakinfo.com/v3/search"
-            self.headers.update({"Authorization": "Bearer " + api_key})
-            self.headers.update({"Content-Type": "application/x-www-form-urlencoded"})
+            headers = {
+                "Authorization": "Bearer " + api_key,
+                "Content-Type": "application/x-www-form-urlencoded",
+            }
 
             payload = {"type": user_query, "query": self.target}
-            req = self.make_request(url, meth="POST", data=payload, timeout=30)
-            self.headers.popitem()
-            self.headers.popitem()
+            req = self.make_request(
+                url,
+                meth="POST",
+                data=payload,
+                timeout=30,
+                headers=headers,
+                provider="weleakinfo",
+                rate_key=api_key,
+                query_type=user_query,
+                valid=weleakinfo_answered,
+            )
             response = req.json()
             if req.status_code == 400:
                 c.bad_news(
@@ -711,9 +961,15 @@ class target:
             url = "https://api.weleakinfo.com/v3/public/email/{query}".format(
                 query=self.target
             )
-            self.headers.update({"Authorization": "Bearer " + api_key})
-            req = self.make_request(url, timeout=30)
-            self.headers.popitem()
+            req = self.make_request(
+                url,
+                timeout=30,
+                headers={"Authorization": "Bearer " + api_key},
+                provider="weleakinfo",
+                rate_key=api_key,
+                query_type="public",
+                valid=weleakinfo_answered,
+            )
             response = req.json()
             if req.status_code != 200:
                 c.bad_news(f"Got WLI API response code {req.status_code} (public)")
@@ -751,9 +1007,15 @@ class target:
                 search_query = "email" + ":" + '"*@' + self.target + '"'
             else:
                 search_query = user_query + ":" + '"' + self.target + '"'
-            self.headers.update({"Accept": "application/json"})
             req = self.make_request(
-                url + search_query, meth="GET", timeout=60, auth=(api_email, api_key)
+                url + search_query,
+                meth="GET",
+                timeout=60,
+                auth=(api_email, api_key),
+                headers={"Accept": "application/json"},
+                provider="dehashed",
+                rate_key=api_key,
+                query_type=user_query,
             )
             if req.status_code == 200:
                 response = req.json()
@@ -821,7 +1083,6 @@ class target:
                     )
             else:
                 c.bad_news("Dehashed error: status code " + req.status_code)
-            self.headers.popitem()
         except Exception as ex:
             c.bad_news(f"Dehashed error with {self.target}")
             print(ex)
@@ -836,7 +1097,11 @@ class target:
         url = "https://breachdirectory.tk/api/index?username={user}&password={passw}&func={mode}&term={target}".format(user=user, passw=passw, mode=mode, target=self.target)
         try:
             req = self.make_request(
-                    url, timeout=60
+                    url,
+                    timeout=60,
+                    provider="breachdirectory",
+                    rate_key=user,
+                    query_type="pastes",
                 )
             if req.status_code == 200:
                     response = req.json()
@@ -854,7 +1119,11 @@ class target:
                     # Follow up with an aggregated leak sources query
                     url_src = "https://breachdirectory.tk/api/index?username={user}&password={passw}&func={mode}&term={target}".format(user=user, passw=passw, mode="sources", target=self.target)
                     req = self.make_request(
-                        url_src, timeout=60
+                        url_src,
+                        timeout=60,
+                        provider="breachdirectory",
+                        rate_key=user,
+                        query_type="sources",
                     )
                     if req.status_code == 200:
                         response = req.json()
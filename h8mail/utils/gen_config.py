@@ -24,6 +24,38 @@ def gen_config_file():
 ;intelx_maxfile = 10
 ;breachdirectory_user = 
 ;breachdirectory_pass =
+; Requests rate per service and API key, in requests per second or per unit (s, m, h). 0 disables rate limiting
+;rate_hibp = 10/m
+;rate_emailrep = 2
+;rate_scylla = 2
+;rate_weleakinfo = 2.5
+;rate_hunterio = 
+;rate_snusbase = 
+;rate_leaklookup = 
+;rate_dehashed = 
+;rate_breachdirectory = 
+; Requests sent at once per service, when using --workers. intelx.io files are downloaded 4 at a time. 0 removes the limit
+;concurrency_hibp = 1
+;concurrency_dehashed = 
+;concurrency_intelx = 4
+; Retries allowed per service for the whole run, when throttled (429) or failing (5xx). Defaults to 50, 0 disables retries
+;retry_hibp = 50
+;retry_emailrep = 
+;retry_leaklookup = 
+;retry_weleakinfo = 
+; Response cache. Time a service response is reused for, in seconds or with a unit (s, m, h, d). 0 disables caching for the service
+;cache_ttl_hibp = 1d
+;cache_ttl_dehashed = 7d
+;cache_ttl_snusbase = 7d
+;cache_ttl_leaklookup = 7d
+; Time a not found response is reused for
+;cache_negative_ttl = 1h
+; Maximum size of cached responses in MB, least recently used responses are evicted first
+;cache_size = 64
+;cache_file = 
+; Downloaded intelx.io files are kept and reused by later targets and runs. Maximum size in MB, 0 disables the store
+;intelx_cache_size = 2048
+;intelx_cache_dir = 
 """
         dest_config.write(config)
         c.good_news(
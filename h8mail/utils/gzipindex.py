@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+
+from .colors import colors as c
+from .matcher import GZIP_MAGIC, gzip_blocks, inflate_blocks, read_blocks
+import bisect
+import ctypes
+import ctypes.util
+import os
+import struct
+import zlib
+
+SEEK_SUFFIX = ".h8seek"
+SEEK_MAGIC = b"H8SEEK02"
+# Gzip file size and mtime, seek point spacing, number of seek points
+SEEK_HEADER = struct.Struct(">QdQI")
+# Decompressed offset, compressed offset, lines before, compressed window length
+SEEK_POINT = struct.Struct(">QQQI")
+# Tar member data offset, size, lines before, name length
+SEEK_MEMBER = struct.Struct(">QQQH")
+WINDOW_SIZE = 32768
+OUT_SIZE = 1 << 18
+
+Z_OK = 0
+Z_STREAM_END = 1
+Z_DATA_ERROR = -3
+Z_BUF_ERROR = -5
+Z_BLOCK = 5
+
+
+class _z_stream(ctypes.Structure):
+    _fields_ = [
+        ("next_in", ctypes.c_void_p),
+        ("avail_in", ctypes.c_uint),
+        ("total_in", ctypes.c_ulong),
+        ("next_out", ctypes.c_void_p),
+        ("avail_out", ctypes.c_uint),
+        ("total_out", ctypes.c_ulong),
+        ("msg", ctypes.c_char_p),
+        ("state", ctypes.c_void_p),
+        ("zalloc", ctypes.c_void_p),
+        ("zfree", ctypes.c_void_p),
+        ("opaque", ctypes.c_void_p),
+        ("data_type", ctypes.c_int),
+        ("adler", ctypes.c_ulong),
+        ("reserved", ctypes.c_ulong),
+    ]
+
+
+def _load_libz():
+    """
+    Loads the system zlib, needed to stop inflating at deflate block boundaries when building seek indexes.
+    Returns None when unavailable, gzip files are then always decompressed from the start.
+    """
+    try:
+        libz = ctypes.CDLL(ctypes.util.find_library("z") or "libz.so.1")
+        libz.zlibVersion.restype = ctypes.c_char_p
+        libz.inflateInit2_.argtypes = [
+            ctypes.POINTER(_z_stream),
+            ctypes.c_int,
+            ctypes.c_char_p,
+            ctypes.c_int,
+        ]
+        libz.inflate.argtypes = [ctypes.POINTER(_z_stream), ctypes.c_int]
+        libz.inflateReset.argtypes = [ctypes.POINTER(_z_stream)]
+        libz.inflateEnd.argtypes = [ctypes.POINTER(_z_stream)]
+        return libz
+    except (OSError, AttributeError):
+        return None
+
+
+_libz = _load_libz()
+
+
+def seek_index_path(filepath):
+    return filepath + SEEK_SUFFIX
+
+
+def can_build_seek_index():
+    return _libz is not None
+
+
+class seek_index_builder:
+    """
+    Decompresses a raw gzip file object while recording seek points, the zran way.
+    Seek points are recorded at the first byte aligned deflate block boundary after every span bytes of output,
+    with the last 32 KB of output as window and the number of lines before them.
+    Iterating yields decompressed blocks and keeps count of bytes and lines, like counted_blocks.
+    Tar archives members are saved along seek points when listed in self.members.
+    """
+
+    def __init__(self, fp, span, size=1 << 20):
+        self.fp = fp
+        self.span = span
+        self.size = size
+        self.bytes = 0
+        self.lines = 0
+        self.points = [(0, 0, 0, b"")]
+        self.members = []
+
+    def __iter__(self):
+        strm = _z_stream()
+        wbits = zlib.MAX_WBITS | 16
+        ret = _libz.inflateInit2_(
+            ctypes.byref(strm), wbits, _libz.zlibVersion(), ctypes.sizeof(strm)
+        )
+        if ret != Z_OK:
+            raise zlib.error(f"inflateInit2 failed ({ret})")
+        out = ctypes.create_string_buffer(OUT_SIZE)
+        window = b""
+        last = 0
+        started = False
+        done = False
+        in_pos = 0
+        try:
+            for data in read_blocks(self.fp, self.size):
+                address = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p).value
+                offset = 0
+                while offset < len(data) and not done:
+                    if not started and not GZIP_MAGIC.startswith(data[offset : offset + 2]):
+                        done = True
+                        break
+                    started = True
+                    strm.next_in = address + offset
+                    strm.avail_in = len(data) - offset
+                    strm.next_out = ctypes.addressof(out)
+                    strm.avail_out = OUT_SIZE
+                    ret = _libz.inflate(ctypes.byref(strm), Z_BLOCK)
+                    if ret == Z_BUF_ERROR and strm.avail_in == len(data) - offset:
+                        ret = Z_DATA_ERROR
+                    if ret not in (Z_OK, Z_STREAM_END, Z_BUF_ERROR):
+                        raise zlib.error(
+                            "Error {ret} while decompressing data: {msg}".format(
+                                ret=ret, msg=strm.msg
+                            )
+                        )
+                    offset = len(data) - strm.avail_in
+                    produced = OUT_SIZE - strm.avail_out
+                    if produced:
+                        block = ctypes.string_at(out, produced)
+                        window = (window + block)[-WINDOW_SIZE:]
+                        self.bytes += produced
+                        self.lines += block.count(b"\n")
+                        yield block
+                    if ret == Z_STREAM_END:
+                        _libz.inflateReset(ctypes.byref(strm))
+                        started = False
+                    elif (
+                        strm.data_type & 128
+                        and not strm.data_type & 64
+                        and not strm.data_type & 7
+                        and self.bytes - last >= self.span
+                    ):
+                        self.points.append((self.bytes, in_pos + offset, self.lines, window))
+                        last = self.bytes
+                in_pos += len(data)
+                if done:
+                    break
+            if started:
+                raise EOFError(
+                    "Compressed file ended before the end-of-stream marker was reached"
+                )
+        finally:
+            _libz.inflateEnd(ctypes.byref(strm))
+
+    def save(self, filepath, st):
+        """
+        Writes seek points next to filepath, st being the stat result of filepath taken before decompressing it
+        """
+        windows = [zlib.compress(window) for _, _, _, window in self.points]
+        path = seek_index_path(filepath)
+        with open(path + ".tmp", "wb") as fp:
+            fp.write(SEEK_MAGIC)
+            fp.write(SEEK_HEADER.pack(st.st_size, st.st_mtime, self.span, len(self.points)))
+            for (out, offset, lines, _), window in zip(self.points, windows):
+                fp.write(SEEK_POINT.pack(out, offset, lines, len(window)))
+            fp.write(b"".join(windows))
+            fp.write(struct.pack(">I", len(self.members)))
+            for name, offset, size, lines in self.members:
+                raw = name.encode("utf-8", "surrogateescape")
+                fp.write(SEEK_MEMBER.pack(offset, size, lines, len(raw)) + raw)
+        os.replace(path + ".tmp", path)
+
+
+class gzip_seek_index:
+    """
+    Seek points of a gzip file, loaded from the seek index saved next to it.
+    Windows are read from disk when needed. For tar archives, members lists (name, data offset, size, lines before)
+    of every regular file member, None otherwise.
+    """
+
+    def __init__(self, filepath):
+        self.path = seek_index_path(filepath)
+        with open(self.path, "rb") as fp:
+            if fp.read(len(SEEK_MAGIC)) != SEEK_MAGIC:
+                raise ValueError(f"{self.path} is not a seek index")
+            self.size, self.mtime, self.span, count = SEEK_HEADER.unpack(
+                fp.read(SEEK_HEADER.size)
+            )
+            table = fp.read(SEEK_POINT.size * count)
+            self.points = []
+            self.windows = []
+            window_pos = len(SEEK_MAGIC) + SEEK_HEADER.size + len(table)
+            for out, offset, lines, window_len in SEEK_POINT.iter_unpack(table):
+                self.points.append((out, offset, lines))
+                self.windows.append((window_pos, window_len))
+                window_pos += window_len
+            self.starts = [p[0] for p in self.points]
+            fp.seek(window_pos)
+            (count,) = struct.unpack(">I", fp.read(4))
+            self.members = []
+            for _ in range(count):
+                offset, size, lines, name_len = SEEK_MEMBER.unpack(fp.read(SEEK_MEMBER.size))
+                name = fp.read(name_len).decode("utf-8", "surrogateescape")
+                self.members.append((name, offset, size, lines))
+        if not self.members:
+            self.members = None
+
+    def window(self, k):
+        with open(self.path, "rb") as fp:
+            fp.seek(self.windows[k][0])
+            return zlib.decompress(fp.read(self.windows[k][1]))
+
+
+def load_seek_index(filepath):
+    """
+    Returns the gzip_seek_index of filepath, or None when missing, unreadable or older than filepath
+    """
+    try:
+        st = os.stat(filepath)
+        index = gzip_seek_index(filepath)
+    except (OSError, ValueError, struct.error):
+        return None
+    if index.size != st.st_size or index.mtime != st.st_mtime or not index.points:
+        return None
+    return index
+
+
+def seek_blocks(fp, index, k, size=1 << 20):
+    """
+    Yields decompressed blocks of raw gzip file fp, starting at seek point k of index.
+    The deflate stream is resumed with the point window as dictionary, following gzip members
+    are decompressed like gzip_blocks() does.
+    """
+    out, offset, _ = index.points[k]
+    fp.seek(offset)
+    if offset == 0:
+        yield from gzip_blocks(fp, size)
+        return
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=index.window(k))
+    for data in read_blocks(fp, size):
+        while data and not decompressor.eof:
+            block = decompressor.decompress(data, size << 3)
+            if block:
+                yield block
+            data = decompressor.unconsumed_tail
+        if decompressor.eof:
+            break
+    if not decompressor.eof:
+        raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+    # Skips the gzip trailer of the current member
+    rest = decompressor.unused_data
+    while len(rest) < 8:
+        data = fp.read(8 - len(rest))
+        if not data:
+            return
+        rest += data
+
+    def following():
+        yield rest[8:]
+        yield from read_blocks(fp, size)
+
+    yield from inflate_blocks(following(), size)
+
+
+def segment_blocks(blocks, length, aligned):
+    """
+    Trims the decompressed blocks of a segment to the lines starting in its first length bytes.
+    The partial line the segment starts with belongs to the previous segment, unless aligned.
+    Last line is followed past length up to its end. length of None reads up to the end of file.
+    """
+    pos = 0
+    for block in blocks:
+        begin = 0
+        if not aligned:
+            begin = block.find(b"\n") + 1
+            if begin == 0:
+                pos += len(block)
+                if length is not None and pos >= length:
+                    return
+                continue
+            aligned = True
+            if length is not None and pos + begin >= length:
+                return
+        if length is not None and pos + len(block) >= length:
+            cut = block.find(b"\n", max(length - 1 - pos, begin))
+            if cut != -1:
+                yield block[begin : cut + 1]
+                return
+        yield block[begin:] if begin else block
+        pos += len(block)
+
+
+class gzip_seek_reader:
+    """
+    Reads lines of a gzip file at decompressed byte offsets, resuming decompression from the nearest seek point
+    """
+
+    def __init__(self, filepath, index):
+        self.fp = open(filepath, "rb")
+        self.index = index
+        self.segment = None
+        self.blocks = None
+        self.buf = b""
+        self.pos = 0
+
+    def seek(self, offset):
+        k = bisect.bisect_right(self.index.starts, offset) - 1
+        if self.blocks is None or k != self.segment or offset < self.pos:
+            self.blocks = seek_blocks(self.fp, self.index, k)
+            self.segment = k
+            self.buf = b""
+            self.pos = self.index.points[k][0]
+        while self.pos + len(self.buf) <= offset:
+            self.pos += len(self.buf)
+            self.buf = next(self.blocks, b"")
+            if not self.buf:
+                return
+        self.buf = self.buf[offset - self.pos :]
+        self.pos = offset
+
+    def readline(self):
+        line = b""
+        while True:
+            newline = self.buf.find(b"\n")
+            if newline != -1:
+                line += self.buf[: newline + 1]
+                self.buf = self.buf[newline + 1 :]
+                self.pos += newline + 1
+                return line
+            line += self.buf
+            self.pos += len(self.buf)
+            self.buf = next(self.blocks, b"")
+            if not self.buf:
+                return line
+
+    def close(self):
+        self.fp.close()
+
+
+def save_seek_index(builder, filepath, st):
+    """
+    Saves the seek points of builder next to filepath when it has more than one
+    """
+    if len(builder.points) < 2:
+        return
+    try:
+        builder.save(filepath, st)
+        c.info_news(
+            f"Saved {len(builder.points)} seek points of {filepath} for parallel search"
+        )
+    except OSError as e:
+        c.info_news(f"Could not save seek index of {filepath}: {e}")
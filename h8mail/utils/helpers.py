@@ -8,20 +8,32 @@ import csv
 import os
 import glob
 from .version import __version__
+from .gzipindex import SEEK_SUFFIX
+from .sessions import http_request
 import requests
 import json
 
 
+def is_seek_index(filename):
+    """
+    Tells if filename is a seek index saved next to a gzip file, or a temporary one left by an interrupted save
+    """
+    return filename.endswith(SEEK_SUFFIX) or filename.endswith(SEEK_SUFFIX + ".tmp")
+
+
 def find_files(to_parse, pattern=""):
     """
     Returns list of files from t_parse filepath.
     Supports using globing (*) in filepaths.
     Can check for patterns such as 'gz'.
+    Seek indexes saved next to gzip files are skipped when walking folders and globs.
     """
     allfiles = []
     if "*" in to_parse:
         glob_result = glob.glob(to_parse)
         for g in glob_result:
+            if is_seek_index(g):
+                continue
             allfiles.append(g)
             c.info_news(f"Using file {g}")
     if os.path.isfile(to_parse):
@@ -31,7 +43,7 @@ def find_files(to_parse, pattern=""):
     elif os.path.isdir(to_parse):
         for root, _, filenames in os.walk(to_parse):
             for filename in filenames:
-                if pattern in filename:
+                if pattern in filename and not is_seek_index(filename):
                     c.info_news("Using file {}".format(os.path.join(root, filename)))
                     allfiles.append(os.path.join(root, filename))
     return allfiles
@@ -160,9 +172,9 @@ def save_results_csv(dest_csv, target_obj_list):
             writer.writerow(["Target", "Type", "Data"])
             c.good_news("Writing to CSV")
             for t in target_obj_list:
-                for i in range(len(t.data)):
-                    if len(t.data[i]) == 2:  # Contains data header + body
-                        writer.writerow([t.target, t.data[i][0], t.data[i][1]])
+                for r in t.data:
+                    if r.content is None:  # Local search results are not written
+                        writer.writerow([t.target, r.label, r.value])
         except Exception as ex:
             c.bad_news("Error writing to csv")
             print(ex)
@@ -173,7 +185,7 @@ def check_latest_version():
     Fetches local version and compares it to github api tag version
     """
     try:
-        response = requests.request(
+        response = http_request(
             url="https://api.github.com/repos/khast3x/h8mail/releases/latest", method="GET"
         )
         data = response.json()
@@ -195,7 +207,8 @@ def check_scylla_online():
     # Supress SSL Warning on UI
     # https://github.com/khast3x/h8mail/issues/64
     try:
-        re = requests.head(
+        re = http_request(
+            "HEAD",
             url="https://scylla.so", verify=False, auth=requests.auth.HTTPBasicAuth("sammy", "BasicPassword!"), timeout=10,
         )
         if re.status_code == 200:
@@ -1,11 +1,30 @@
 #!/usr/bin/env python3
 
-import requests
+from .sessions import http_request
 import time
 import json
-import sys
 import re
 
+# Delays between polls of a search's results: fast first polls, then doubled while no new result comes
+POLL_MIN = 0.25
+POLL_MAX = 4.0
+
+
+class intelx_error(Exception):
+	"""
+	Raised when the intelx.io API refuses a request
+	"""
+
+
+def next_poll_delay(delay, got_results):
+	"""
+	Returns the delay before the next poll of a search, given the last delay and if the last poll returned results
+	"""
+	if got_results:
+		return POLL_MIN
+	return min(POLL_MAX, delay * 2)
+
+
 class intelx:
 
 	# API_ROOT = 'https://public.intelx.io'
@@ -42,6 +61,7 @@ class intelx:
 			return "402 | Payment required."
 		if code == 404:
 			return "404 | Not Found"
+		return f"{code} | Unexpected response"
 
 	def cleanup_treeview(self, treeview):
 		"""
@@ -58,7 +78,7 @@ class intelx:
 		Return a JSON object with the current user's API capabilities
 		"""
 		h = {'x-key' : self.API_KEY, 'User-Agent': self.USER_AGENT}
-		r = requests.get(f"{self.API_ROOT}/authenticate/info", headers=h)
+		r = http_request("GET", f"{self.API_ROOT}/authenticate/info", headers=h)
 		return r.json()
 
 	def FILE_PREVIEW(self, ctype, mediatype, format, sid, bucket='', e=0, lines=8):
@@ -68,7 +88,7 @@ class intelx:
 		- 0: Text
 		- 1: Picture
 		"""
-		r = requests.get(f"{self.API_ROOT}/file/preview?c={ctype}&m={mediatype}&f={format}&sid={sid}&b={bucket}&e={e}&l={lines}&k={self.API_KEY}")
+		r = http_request("GET", f"{self.API_ROOT}/file/preview?c={ctype}&m={mediatype}&f={format}&sid={sid}&b={bucket}&e={e}&l={lines}&k={self.API_KEY}")
 		return r.text
 
 	def FILE_VIEW(self, ctype, mediatype, sid, bucket='',escape=0):
@@ -103,7 +123,7 @@ class intelx:
 			format = 0
 		else:
 			format = 1
-		r = requests.get(f"{self.API_ROOT}/file/view?f={format}&storageid={sid}&bucket={bucket}&escape={escape}&k={self.API_KEY}")
+		r = http_request("GET", f"{self.API_ROOT}/file/view?f={format}&storageid={sid}&bucket={bucket}&escape={escape}&k={self.API_KEY}")
 		return r.text
 	
 	def FILE_READ(self, id, type=0, bucket="", filename=""):
@@ -124,19 +144,31 @@ class intelx:
 		name option:
 		- Specify the name to save the file as (e.g document.pdf).
 		"""
-		h = {'x-key' : self.API_KEY, 'User-Agent': self.USER_AGENT}
-		r = requests.get(f"{self.API_ROOT}/file/read?type={type}&systemid={id}&bucket={bucket}", headers=h, stream=True)
 		with open(f"{filename}", "wb") as f:
-			f.write(r.content)
-			f.close()
+			for block in self.FILE_STREAM(id, type, bucket):
+				f.write(block)
 		return True
 
+	def FILE_STREAM(self, id, type=0, bucket="", chunk_size=1 << 20):
+		"""
+		Stream a file's raw contents, yielding blocks of up to chunk_size bytes as they are downloaded.
+		Only one block is held in memory at a time. Same options as FILE_READ.
+		"""
+		h = {'x-key' : self.API_KEY, 'User-Agent': self.USER_AGENT}
+		r = http_request("GET", f"{self.API_ROOT}/file/read?type={type}&systemid={id}&bucket={bucket}", headers=h, stream=True)
+		try:
+			for block in r.iter_content(chunk_size):
+				if block:
+					yield block
+		finally:
+			r.close()
+
 	def FILE_TREE_VIEW(self, sid):
 		"""
 		Show a treeview of an item that has multiple files/folders
 		"""
 		try:
-			r = requests.get(f"{self.API_ROOT}/file/view?f=12&storageid={sid}&k={self.API_KEY}", timeout=5)
+			r = http_request("GET", f"{self.API_ROOT}/file/view?f=12&storageid={sid}&k={self.API_KEY}", timeout=5)
 			if "Could not generate" in r.text:
 				return False
 			return r.text
@@ -238,7 +270,7 @@ class intelx:
 			"media": media,
 			"terminate": terminate
 		}
-		r = requests.post(self.API_ROOT + '/intelligent/search', headers=h, json=p)
+		r = http_request("POST", self.API_ROOT + '/intelligent/search', headers=h, json=p)
 		if r.status_code == 200:
 			return r.json()['id']
 		else:
@@ -327,7 +359,7 @@ class intelx:
 
 		"""
 		h = {'x-key' : self.API_KEY, 'User-Agent': self.USER_AGENT}
-		r = requests.get(self.API_ROOT + f'/intelligent/search/result?id={id}&limit={limit}', headers=h)
+		r = http_request("GET", self.API_ROOT + f'/intelligent/search/result?id={id}&limit={limit}', headers=h)
 		if(r.status_code == 200):
 			return r.json()
 		else:
@@ -338,7 +370,7 @@ class intelx:
 		Terminate a previously initialized search based on its UUID.
 		"""
 		h = {'x-key' : self.API_KEY, 'User-Agent': self.USER_AGENT}
-		r = requests.get(self.API_ROOT + f'/intelligent/search/terminate?id={uuid}', headers=h)
+		r = http_request("GET", self.API_ROOT + f'/intelligent/search/terminate?id={uuid}', headers=h)
 		if(r.status_code == 200):
 			return True
 		else:
@@ -362,7 +394,7 @@ class intelx:
 			"terminate": terminate,
 			"target": target
 		}
-		r = requests.post(self.API_ROOT + '/phonebook/search', headers=h, json=p)
+		r = http_request("POST", self.API_ROOT + '/phonebook/search', headers=h, json=p)
 		if r.status_code == 200:
 			return r.json()['id']
 		else:
@@ -382,7 +414,7 @@ class intelx:
 		- 3: No results yet, but keep trying.
 		"""
 		h = {'x-key' : self.API_KEY, 'User-Agent': self.USER_AGENT}
-		r = requests.get(self.API_ROOT + f'/phonebook/search/result?id={id}&limit={limit}&offset={offset}', headers=h)
+		r = http_request("GET", self.API_ROOT + f'/phonebook/search/result?id={id}&limit={limit}&offset={offset}', headers=h)
 		if(r.status_code == 200):
 			return r.json()
 		else:
@@ -492,14 +524,17 @@ class intelx:
 		done = False
 		search_id = self.INTEL_SEARCH(term, maxresults, buckets, timeout, datefrom, dateto, sort, media, terminate)
 		if(len(str(search_id)) <= 3):
-			print(f"[!] intelx.INTEL_SEARCH() Received {self.get_error(search_id)}")
-			sys.exit()
+			raise intelx_error(f"intelx.INTEL_SEARCH() Received {self.get_error(search_id)}")
+		delay = POLL_MIN
 		while done == False:
-			time.sleep(1) # lets give the backend a chance to aggregate our data
+			time.sleep(delay) # lets give the backend a chance to aggregate our data
 			r = self.query_results(search_id, maxresults)
+			if not isinstance(r, dict):
+				raise intelx_error(f"intelx.INTEL_SEARCH_RESULT() Received {self.get_error(r)}")
 			for a in r['records']:
 				results.append(a)
 			maxresults -= len(r['records'])
+			delay = next_poll_delay(delay, len(r['records']) != 0)
 			if(r['status'] == 1 or r['status'] == 2 or maxresults <= 0):
 				if(maxresults <= 0):
 					self.INTEL_TERMINATE_SEARCH(search_id)
@@ -515,13 +550,16 @@ class intelx:
 		done = False
 		search_id = self.PHONEBOOK_SEARCH(term, maxresults, buckets, timeout, datefrom, dateto, sort, media, terminate, target)
 		if(len(str(search_id)) <= 3):
-			print(f"[!] intelx.PHONEBOOK_SEARCH() Received {self.get_error(search_id)}")
-			sys.exit()
+			raise intelx_error(f"intelx.PHONEBOOK_SEARCH() Received {self.get_error(search_id)}")
+		delay = POLL_MIN
 		while done == False:
-			time.sleep(1) # lets give the backend a chance to aggregate our data
+			time.sleep(delay) # lets give the backend a chance to aggregate our data
 			r = self.query_pb_results(search_id, maxresults)
+			if not isinstance(r, dict):
+				raise intelx_error(f"intelx.PHONEBOOK_SEARCH_RESULT() Received {self.get_error(r)}")
 			results.append(r)
 			maxresults -= len(r['selectors'])
+			delay = next_poll_delay(delay, len(r['selectors']) != 0)
 			if(r['status'] == 1 or r['status'] == 2 or maxresults <= 0):
 				if(maxresults <= 0):
 					self.INTEL_TERMINATE_SEARCH(search_id)
@@ -1,33 +1,330 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-from .intelx import intelx as i
-from time import sleep
+from .intelx import intelx as i, intelx_error, next_poll_delay, POLL_MIN
+from .matcher import read_blocks, scan_blocks, target_matcher
+from concurrent.futures import Future
+from threading import Lock, Thread
 from .colors import colors as c
+from .cache import private_dir
+import hashlib
+import os
+import time
 
+INTELX_CACHE_SIZE = 2048  # MB
 
-def intelx_getsearch(target, intelx, maxfile):
+# File read credits left per API key, counted down by the downloads of the run
+_file_credits = {}
+_file_credits_lock = Lock()
 
-    c.info_news("[" + target + "]>[intelx.io] Starting search")
-    cap = intelx.GET_CAPABILITIES()
-    # print(cap["buckets"])
-    # import json
-    # print(json.dumps(cap, indent=4))
-    c.info_news(
-        "["
-        + target
-        + "]>[intelx.io] Search credits remaining : {creds}".format(
-            creds=cap["paths"]["/intelligent/search"]["Credit"]
+
+def take_file_credit(intelx, cap):
+    """
+    Takes one file read credit of the intelx API key. Credits left are read once per key from the capabilities,
+    then counted down by every download, whatever the target. Returns False when no credit is left
+    """
+    with _file_credits_lock:
+        if intelx.API_KEY not in _file_credits:
+            path = cap.get("paths", {}).get("/file/read")
+            _file_credits[intelx.API_KEY] = None if path is None else path.get("Credit")
+        credits = _file_credits[intelx.API_KEY]
+        if credits is None:
+            return True
+        if credits <= 0:
+            return False
+        _file_credits[intelx.API_KEY] = credits - 1
+        return True
+
+
+class intelx_file_store:
+    """
+    Local store of downloaded intelx.io files, keyed by system ID and shared across targets and runs.
+    Files are named after the SHA-256 of their system ID, and only readable by the current user.
+    Least recently used files are evicted once the store grows over max_size bytes, file modification times
+    being updated on every use
+    """
+
+    def __init__(self, path, max_size):
+        private_dir(path)
+        self.dir = path
+        self.max_size = max_size
+
+    def path(self, systemid):
+        return os.path.join(
+            self.dir, hashlib.sha256(systemid.encode("utf-8")).hexdigest() + ".txt"
         )
-    )
-    available_buckets = []
-    desired_buckets=["leaks.public", "leaks.private", "pastes", "darknet"],
-    for b in cap["buckets"]:
-        if any(b in d for d in desired_buckets):
-            available_buckets.append(b)
+
+    def get(self, systemid):
+        """
+        Returns the path of the stored file of systemid, or None when not stored
+        """
+        path = self.path(systemid)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def put(self, systemid, blocks):
+        """
+        Stores the file of systemid from its blocks and returns its path.
+        Incomplete downloads are not stored
+        """
+        path = self.path(systemid)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb", opener=lambda p, flags: os.open(p, flags, 0o600)) as fp:
+                for block in blocks:
+                    fp.write(block)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict(path)
+        return path
+
+    def evict(self, keep=None):
+        """
+        Removes least recently used files until the store fits in max_size bytes, keep excepted
+        """
+        files = []
+        total = 0
+        for entry in os.scandir(self.dir):
+            if entry.is_file() and entry.name.endswith(".txt"):
+                st = entry.stat()
+                files.append((st.st_mtime, entry.path, st.st_size))
+                total += st.st_size
+        for _, path, size in sorted(files):
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+
+# File store and targets of the run, and found lines per system ID and target
+_store = None
+_refresh = False
+_run_targets = []
+_scans = {}
+_scan_locks = {}
+_scans_lock = Lock()
+
+
+def configure_intelx(user_args, api_keys):
+    """
+    Opens the intelx.io file store, unless --no-cache is set or intelx_cache_size is 0.
+    Reads the intelx_cache_dir and intelx_cache_size (MB) configuration keys.
+    Forgets the clients and scans of the previous run
+    """
+    global _store, _refresh
+    with _clients_lock:
+        _clients.clear()
+    _store = None
+    _refresh = user_args.refresh_cache
+    with _scans_lock:
+        _run_targets.clear()
+        _scans.clear()
+        _scan_locks.clear()
+    if user_args.no_cache:
+        return
+    config = api_keys if api_keys is not None else {}
+    try:
+        max_size = float(config.get("intelx_cache_size") or INTELX_CACHE_SIZE)
+        if max_size <= 0:
+            return
+        path = config.get("intelx_cache_dir") or os.path.join(
+            os.environ.get("XDG_CACHE_HOME")
+            or os.path.join(os.path.expanduser("~"), ".cache"),
+            "h8mail",
+            "intelx",
+        )
+        _store = intelx_file_store(path, int(max_size * (1 << 20)))
+    except Exception as e:
+        c.bad_news("Could not open intelx.io file store, files will not be kept")
+        print(e)
+
+
+def add_intelx_targets(targets):
+    """
+    Adds targets to those searched in every intelx.io file of the run
+    """
+    with _scans_lock:
+        _run_targets.extend(targets)
+
+
+def intelx_store_enabled():
+    return _store is not None
+
+
+def search_stored_file(systemid, target, download):
+    """
+    Returns the (line number, raw line) of target in the stored file of systemid.
+    Missing files are stored from the blocks returned by download(), which returns None to skip the file.
+    A file is scanned once for every target of the run, later targets reusing the scan.
+    Returns None when the file was skipped
+    """
+    with _scans_lock:
+        lock = _scan_locks.setdefault(systemid, Lock())
+    with lock:
+        scan = _scans.setdefault(systemid, {})
+        if target not in scan:
+            path = None if _refresh and not scan else _store.get(systemid)
+            if path is None:
+                blocks = download()
+                if blocks is None:
+                    return None
+                path = _store.put(systemid, blocks)
+            with _scans_lock:
+                pending = [t for t in dict.fromkeys(_run_targets + [target]) if t not in scan]
+            found = {t: [] for t in pending}
+            with open(path, "rb") as fp:
+                for cnt, line, targets in scan_blocks(read_blocks(fp), target_matcher(pending)):
+                    for t in targets:
+                        found[t].append((cnt, line))
+            scan.update(found)
+        return scan[target]
+
+
+class intelx_search:
+    """
+    Search waiting for its results, polled by intelx_client
+    """
+
+    __slots__ = ("id", "remaining", "records", "delay", "due", "future")
+
+    def __init__(self, search_id, maxresults):
+        self.id = search_id
+        self.remaining = maxresults
+        self.records = []
+        self.delay = POLL_MIN
+        self.due = time.monotonic() + POLL_MIN
+        self.future = Future()
+
+
+class intelx_client:
+    """
+    intelx.io client shared by every target of a run, one per API key.
+    Capabilities and buckets are fetched once, as they are the same for every target.
+    Searches of concurrent targets are polled together by a single poller thread, each search being polled
+    fast at first, then less and less often while no new result comes.
+    API errors are raised as intelx_error
+    """
+
+    def __init__(self, key, ua):
+        self.api = i(key=key, ua=ua)
+        self.lock = Lock()
+        self.cap = None
+        self.searches = []
+        self.poller = None
+
+    def capabilities(self):
+        with self.lock:
+            if self.cap is None:
+                cap = self.api.GET_CAPABILITIES()
+                c.info_news(
+                    "[intelx.io] Search credits remaining : {creds}".format(
+                        creds=cap["paths"]["/intelligent/search"]["Credit"]
+                    )
+                )
+                self.cap = cap
+            return self.cap
+
+    def buckets(self):
+        """
+        Returns the buckets of the API key searched by h8mail
+        """
+        desired_buckets = ["leaks.public", "leaks.private", "pastes", "darknet"]
+        return [b for b in self.capabilities()["buckets"] if b in desired_buckets]
+
+    def search(self, term, maxresults=100, buckets=[], media=0):
+        """
+        Starts a search and waits for its results, returned like intelx.search()
+        """
+        search_id = self.api.INTEL_SEARCH(term, maxresults, buckets, media=media)
+        if len(str(search_id)) <= 3:
+            raise intelx_error(
+                f"intelx.INTEL_SEARCH() Received {self.api.get_error(search_id)}"
+            )
+        pending = intelx_search(search_id, maxresults)
+        with self.lock:
+            self.searches.append(pending)
+            if self.poller is None:
+                self.poller = Thread(target=self.poll, daemon=True)
+                self.poller.start()
+        return pending.future.result()
+
+    def poll(self):
+        """
+        Polls every search whose turn has come, until no search is left
+        """
+        while True:
+            with self.lock:
+                if len(self.searches) == 0:
+                    self.poller = None
+                    return
+                wait = min(s.due for s in self.searches) - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            with self.lock:
+                ready = [s for s in self.searches if s.due <= time.monotonic()]
+            for s in ready:
+                try:
+                    done = self.poll_search(s)
+                except Exception as e:
+                    s.future.set_exception(e)
+                    done = True
+                if done:
+                    with self.lock:
+                        self.searches.remove(s)
+
+    def poll_search(self, s):
+        """
+        Fetches the new results of a search. Returns True once the search is done and its future is set
+        """
+        r = self.api.query_results(s.id, s.remaining)
+        if not isinstance(r, dict):
+            raise intelx_error(
+                f"intelx.INTEL_SEARCH_RESULT() Received {self.api.get_error(r)}"
+            )
+        s.records.extend(r["records"])
+        s.remaining -= len(r["records"])
+        s.delay = next_poll_delay(s.delay, len(r["records"]) != 0)
+        s.due = time.monotonic() + s.delay
+        if r["status"] in (1, 2) or s.remaining <= 0:
+            if s.remaining <= 0:
+                self.api.INTEL_TERMINATE_SEARCH(s.id)
+            s.future.set_result({"records": s.records})
+            return True
+        return False
+
+
+_clients = {}
+_clients_lock = Lock()
+
+
+def get_intelx_client(key, ua):
+    """
+    Returns the intelx_client of the run for API key
+    """
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = intelx_client(key, ua)
+        return client
+
+
+def intelx_getsearch(target, client, maxfile):
+
+    c.info_news("[" + target + "]>[intelx.io] Starting search")
+    available_buckets = client.buckets()
     c.info_news("[" + target + "]>[intelx.io] Available buckets for h8mail:")
     print(available_buckets)
     c.info_news("[" + target + "]>[intelx.io] Search in progress (max results : "+ str(maxfile) + ")")
-    search = intelx.search(
+    search = client.search(
         target,
         buckets=available_buckets,
         maxresults=maxfile,
@@ -1,13 +1,28 @@
 # -*- coding: utf-8 -*-
 
-from multiprocessing import Pool
-from .classes import local_breach_target
 from .colors import colors as c
-from .localsearch import raw_in_count, progress
-import gzip
+from .gzipindex import (
+    can_build_seek_index,
+    load_seek_index,
+    save_seek_index,
+    seek_blocks,
+    seek_index_builder,
+    segment_blocks,
+)
+from .localsearch import (
+    CHUNK_SIZE,
+    found_targets,
+    print_found,
+    push_found,
+    push_done,
+    shared_matcher,
+    stream_search,
+)
+from .matcher import target_matcher, counted_blocks, gzip_blocks, scan_blocks
+from .tarstream import TAR_BLOCK, block_stream, is_tar, tar_members
+import bisect
 import os
 import sys
-import signal
 
 
 def progress_gzip(count):
@@ -18,111 +33,191 @@ def progress_gzip(count):
     sys.stdout.write("\033[K")
 
 
-def gzip_worker(filepath, target_list):
+def scan_gzip(filepath, blocks, matcher, members=None):
     """
-    Searches for every email from target_list in every line of filepath.
-    Uses python native gzip lib to decompress file line by line.
-    Archives with multiple files are read as long single files.
-    Attempts to decode line using cp437. If it fails, catch and use raw data.
+    Scans the decompressed blocks of filepath for matcher targets, yielding lists of found local_breach_targets.
+    Tar archives are searched member by member, skipping tar headers, with line numbers starting over in each member.
+    When members is a list, (name, data offset, size, lines before) of every member is appended to it.
     """
+    stream = block_stream(blocks)
+    if not is_tar(stream.peek(TAR_BLOCK)):
+        for cnt, line, targets in scan_blocks(stream.chunks(), matcher):
+            yield found_targets(filepath, cnt, line, targets)
+        return
+    for name, size in tar_members(stream):
+        if members is not None:
+            members.append((name, stream.offset, size, stream.lines))
+        for cnt, line, targets in scan_blocks(stream.chunks(size), matcher):
+            yield found_targets(filepath, cnt, line, targets, name)
+
+
+def scan_segment(filepath, fp, index, segment, matcher):
+    """
+    Scans the lines starting in a segment of the seek index of filepath, yielding lists of found local_breach_targets.
+    Line numbers are relative to the first line of the segment.
+    """
+    start = index.points[segment][0]
+    end = index.points[segment + 1][0] if segment + 1 < len(index.points) else None
+    aligned = segment == 0 or index.window(segment).endswith(b"\n")
+    blocks = segment_blocks(
+        seek_blocks(fp, index, segment), None if end is None else end - start, aligned
+    )
+    for cnt, line, targets in scan_blocks(blocks, matcher, 0 if aligned else 1):
+        yield found_targets(filepath, cnt, line, targets)
+
+
+def scan_tar_segment(filepath, fp, index, segment, matcher):
+    """
+    Scans the tar members data lines starting in a segment of the seek index of filepath,
+    yielding lists of found local_breach_targets.
+    Members spanning several segments are shared between their workers, line numbers are counted from the
+    start of the member using the number of lines before seek points and members.
+    """
+    start, _, lines_before = index.points[segment]
+    end = index.points[segment + 1][0] if segment + 1 < len(index.points) else None
+    window = index.window(segment)
+    stream = block_stream(seek_blocks(fp, index, segment), start, lines_before)
+    first = max(bisect.bisect_right([m[1] for m in index.members], start) - 1, 0)
+    for name, offset, size, lines in index.members[first:]:
+        if end is not None and offset >= end:
+            break
+        if offset + size <= start:
+            continue
+        begin = max(start, offset)
+        stream.skip(begin - stream.offset)
+        if begin == offset:
+            aligned, first_line = True, 0
+        else:
+            aligned = window.endswith(b"\n")
+            first_line = lines_before - lines + (0 if aligned else 1)
+        length = None if end is None or end >= offset + size else end - begin
+        blocks = segment_blocks(stream.chunks(offset + size - begin), length, aligned)
+        for cnt, line, targets in scan_blocks(blocks, matcher, first_line):
+            yield found_targets(filepath, cnt, line, targets, name)
+
+
+def gzip_worker(task_id, filepath, segment=None, span=0):
+    """
+    Searches for every target of the shared matcher in every line of filepath.
+    File is decompressed in large blocks with zlib, and whole blocks are searched at once.
+    Tar archives are searched member by member, other archives with multiple files are read as long single files.
+    With a segment number, only lines starting in this segment of the seek index are searched.
+    Otherwise the whole file is searched, and a seek index with a point every span bytes is saved next to it.
+    Only lines holding a target are decoded using cp437, and pushed to the result queue as soon as found.
+    """
+    lines = None
     try:
-        found_list = []
-        size = os.stat(filepath).st_size
-        with gzip.open(filepath, "r") as gzipfile:
+        st = os.stat(filepath)
+        with open(filepath, "rb") as gzipfile:
+            if segment is not None:
+                index = load_seek_index(filepath)
+                if index is None:
+                    raise ValueError(f"Seek index of {filepath} is outdated")
+                c.info_news(
+                    "Worker [{PID}] is searching for targets in {filepath} (segment {segment} of {count} at {start:,.0f} MB)".format(
+                        PID=os.getpid(),
+                        filepath=filepath,
+                        segment=segment + 1,
+                        count=len(index.points),
+                        start=index.points[segment][0] / float(1 << 20),
+                    )
+                )
+                if index.members is not None:
+                    # Tar members line numbers are already counted from the start of each member
+                    found_lists = scan_tar_segment(
+                        filepath, gzipfile, index, segment, shared_matcher()
+                    )
+                    segment_lines = 0
+                else:
+                    found_lists = scan_segment(
+                        filepath, gzipfile, index, segment, shared_matcher()
+                    )
+                    segment_lines = None
+                    if segment + 1 < len(index.points):
+                        segment_lines = index.points[segment + 1][2] - index.points[segment][2]
+                for found in found_lists:
+                    push_found(task_id, found)
+                lines = segment_lines
+                return
             c.info_news(
                 "Worker [{PID}] is searching for targets in {filepath} ({size:,.0f} MB)".format(
-                    PID=os.getpid(), filepath=filepath, size=size / float(1 << 20)
+                    PID=os.getpid(), filepath=filepath, size=st.st_size / float(1 << 20)
                 )
             )
-            for cnt, line in enumerate(gzipfile):
-                for t in target_list:
-                    if t in str(line):
-                        try:
-                            decoded = str(line, "cp437")
-                            found_list.append(
-                                local_breach_target(t, filepath, cnt, decoded)
-                            )
-                            c.good_news(
-                                f"Found occurrence [{filepath}] Line {cnt}: {decoded}"
-                            )
-                        except Exception as e:
-                            c.bad_news(
-                                f"Got a decoding error line {cnt} - file: {filepath}"
-                            )
-                            c.good_news(
-                                f"Found occurrence [{filepath}] Line {cnt}: {line}"
-                            )
-                            found_list.append(
-                                local_breach_target(t, filepath, cnt, str(line))
-                            )
-        return found_list
+            if span > 0 and st.st_size > span and can_build_seek_index():
+                blocks = seek_index_builder(gzipfile, span)
+                members = blocks.members
+            else:
+                blocks = counted_blocks(gzip_blocks(gzipfile))
+                members = None
+            for found in scan_gzip(filepath, blocks, shared_matcher(), members):
+                push_found(task_id, found)
+        lines = blocks.lines
+        if isinstance(blocks, seek_index_builder):
+            save_seek_index(blocks, filepath, st)
     except Exception as e:
         c.bad_news("Something went wrong with gzip worker")
         print(e)
+    finally:
+        push_done(task_id, lines)
+
 
+def gzip_tasks(filepath, chunk_size):
+    """
+    Returns the search tasks of a gzip file, one per segment of its seek index.
+    Files without an up to date seek index are searched by a single task, which builds it.
+    """
+    index = load_seek_index(filepath)
+    if chunk_size <= 0 or index is None:
+        return [(filepath, None, chunk_size)]
+    return [(filepath, segment) for segment in range(len(index.points))]
 
-def local_gzip_search(files_to_parse, target_list):
+
+def iter_local_gzip_search(files_to_parse, target_list, chunk_size=CHUNK_SIZE):
     """
     Receives list of all files to check for target_list.
-    Starts a worker pool, one worker per file.
-    Return list of local_breach_targets objects to be tranformed in target objects.
+    Starts a worker pool, one worker per file, or per segment of files with a seek index.
+    Big files get a seek index with a seek point every chunk_size bytes of decompressed data on their first search.
+    Yields local_breach_targets objects to be tranformed in target objects, as soon as they are found.
     """
-    original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
-    pool = Pool()
-    found_list = []
-    signal.signal(signal.SIGINT, original_sigint_handler)
-    # Launch
-    try:
-        async_results = [
-            pool.apply_async(gzip_worker, args=(f, target_list))
-            for i, f in enumerate(files_to_parse)
-        ]
-        for r in async_results:
-            if r.get() is not None:
-                found_list.extend(r.get(60))
-    except KeyboardInterrupt:
-        c.bad_news("Caught KeyboardInterrupt, terminating workers")
-        pool.terminate()
-    else:
-        c.info_news("Terminating worker pool")
-        pool.close()
-    pool.join()
-    return found_list
+    tasks = [task for f in files_to_parse for task in gzip_tasks(f, chunk_size)]
+    return stream_search(gzip_worker, tasks, target_list)
+
+
+def local_gzip_search(files_to_parse, target_list, chunk_size=CHUNK_SIZE):
+    """
+    Return list of local_breach_targets objects found by iter_local_gzip_search()
+    """
+    return list(iter_local_gzip_search(files_to_parse, target_list, chunk_size))
+
+
+def progress_gzip_blocks(fp):
+    """
+    Yields decompressed blocks from raw gzip file fp while printing the number of lines checked
+    """
+    count = 0
+    for block in gzip_blocks(fp):
+        count += block.count(b"\n")
+        progress_gzip(count)
+        yield block
 
 
 def local_search_single_gzip(files_to_parse, target_list):
     """
     Single process searching of every target_list emails, in every files_to_parse list.
     To be used when stability for big files is a priority
+    Tar archives are searched member by member.
     Return list of local_breach_target objects to be tranformed in target objects
     """
     found_list = []
+    matcher = target_matcher(target_list)
     for file_to_parse in files_to_parse:
-        with gzip.open(file_to_parse, "r") as fp:
+        with open(file_to_parse, "rb") as fp:
             size = os.stat(file_to_parse).st_size
             c.info_news(
                 f"Searching for targets in {file_to_parse} ({size} bytes)"
             )
-            for cnt, line in enumerate(fp):
-                progress_gzip(cnt)
-                for t in target_list:
-                    if t in str(line):
-                        try:
-                            decoded = str(line, "cp437")
-                            found_list.append(
-                                local_breach_target(t, file_to_parse, cnt, decoded)
-                            )
-                            c.good_news(
-                                f"Found occurrence [{file_to_parse}] Line {cnt}: {decoded}"
-                            )
-                        except:
-                            c.bad_news(
-                                f"Got a decoding error line {cnt} - file: {file_to_parse}"
-                            )
-                            c.good_news(
-                                f"Found occurrence [{file_to_parse}] Line {cnt}: {line}"
-                            )
-                            found_list.append(
-                                local_breach_target(t, file_to_parse, cnt, str(line))
-                            )
+            for found in scan_gzip(file_to_parse, progress_gzip_blocks(fp), matcher):
+                print_found(found)
+                found_list.extend(found)
     return found_list
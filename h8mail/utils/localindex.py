@@ -0,0 +1,501 @@
+# -*- coding: utf-8 -*-
+
+from multiprocessing import Pool
+from .colors import colors as c
+from .gzipindex import gzip_seek_reader, load_seek_index
+from .localsearch import found_targets, print_found
+from .matcher import encode_target, read_blocks
+from .tarstream import TAR_BLOCK, block_stream, is_tar, tar_members
+import gzip
+import hashlib
+import heapq
+import json
+import mmap
+import os
+import re
+import shutil
+import signal
+import struct
+import tempfile
+
+# Local parts take every character allowed unquoted by RFC 5322, such as + and '
+EMAIL_PATTERN = re.compile(rb"[\w\.!#$%&'*+/=?^`{|}~-]+@[\w\.-]+")
+LOCAL_SEPARATOR = re.compile(rb"[^\w\.-]")
+# Email hash, file id, tar member id (0 outside tar archives), line number, line byte offset
+RECORD = struct.Struct(">8sIIQQ")
+RUN_RECORDS = 1 << 20
+MERGE_FANIN = 256
+MAX_SEGMENTS = 8
+INDEX_MANIFEST = "manifest.json"
+# Bumped when records or the way emails are extracted change, indexes of other versions are rebuilt
+INDEX_VERSION = 3
+
+
+def normalize_email(raw):
+    return raw.strip(b".-").lower()
+
+
+def email_key(raw):
+    """
+    Returns the 8 bytes hash records are sorted and searched by
+    """
+    return hashlib.blake2b(normalize_email(raw), digest_size=8).digest()
+
+
+def open_breach(filepath):
+    """
+    Opens a breach file for raw reading. Gzip files are detected by their magic bytes and decompressed.
+    """
+    with open(filepath, "rb") as fp:
+        magic = fp.read(2)
+    if magic == b"\x1f\x8b":
+        return gzip.open(filepath, "rb")
+    return open(filepath, "rb")
+
+
+def open_breach_lines(filepath):
+    """
+    Opens a breach file to read lines at byte offsets.
+    Gzip files with a seek index resume decompression at the nearest seek point instead of the start of file.
+    """
+    index = load_seek_index(filepath)
+    if index is not None:
+        return gzip_seek_reader(filepath, index)
+    return open_breach(filepath)
+
+
+def hashed_blocks(fp, digest):
+    """
+    Yields raw blocks from fp while updating digest with their content
+    """
+    for block in read_blocks(fp):
+        digest.update(block)
+        yield block
+
+
+def content_hash(filepath):
+    digest = hashlib.blake2b()
+    with open_breach(filepath) as fp:
+        for _ in hashed_blocks(fp, digest):
+            pass
+    return digest.hexdigest()
+
+
+def email_variants(raw):
+    """
+    Yields the emails a match may stand for: the whole match, then what follows every character of its local part
+    other than letters, digits, _, . and -. A line holding mail='john+tag@x.com is indexed under mail='john+tag@x.com, 'john+tag@x.com,
+    john+tag@x.com and tag@x.com
+    """
+    yield raw
+    at = raw.index(b"@")
+    for m in LOCAL_SEPARATOR.finditer(raw, 0, at):
+        if m.end() < at:
+            yield raw[m.end() :]
+
+
+def _extract(buf, end, line_no, base):
+    counted = 0
+    keys = set()
+    for m in EMAIL_PATTERN.finditer(buf, 0, end):
+        line_start = buf.rfind(b"\n", 0, m.start()) + 1
+        if line_start != counted:
+            line_no += buf.count(b"\n", counted, line_start)
+            counted = line_start
+            keys = set()
+        for raw in email_variants(m.group()):
+            key = email_key(raw)
+            if key not in keys:
+                keys.add(key)
+                yield key, line_no, base + line_start
+
+
+def extract_emails(blocks, base=0):
+    """
+    Finds emails in an iterable of raw byte blocks, carrying partial lines over to the next block.
+    Yields (email hash, line number, line byte offset) for every email found, offsets starting at base.
+    """
+    line_no = 0
+    carry = b""
+    for block in blocks:
+        buf = carry + block if carry else block
+        cut = buf.rfind(b"\n") + 1
+        if cut == 0:
+            carry = buf
+            continue
+        carry = buf[cut:]
+        yield from _extract(buf, cut, line_no, base)
+        line_no += buf.count(b"\n", 0, cut)
+        base += cut
+    if carry:
+        yield from _extract(carry, len(carry), line_no, base)
+
+
+def write_run(records, run_dir):
+    """
+    Sorts records and writes them to a new run file in run_dir. Returns run file path.
+    """
+    records.sort()
+    fd, path = tempfile.mkstemp(dir=run_dir, suffix=".run")
+    with os.fdopen(fd, "wb") as fp:
+        fp.write(b"".join(records))
+    return path
+
+
+def iter_run(path):
+    with open(path, "rb") as fp:
+        for block in read_blocks(fp, RECORD.size << 16):
+            for i in range(0, len(block), RECORD.size):
+                yield block[i : i + RECORD.size]
+
+
+def _merge(runs, dest, dead):
+    with open(dest, "wb") as fp:
+        for record in heapq.merge(*[iter_run(r) for r in runs]):
+            if record[8:12] not in dead:
+                fp.write(record)
+
+
+def merge_runs(runs, dest, dead=()):
+    """
+    Merges sorted run files in dest, dropping records of dead file ids.
+    Runs are merged MERGE_FANIN at a time to bound open files.
+    """
+    dead = {struct.pack(">I", file_id) for file_id in dead}
+    intermediate = []
+    while len(runs) > MERGE_FANIN:
+        merged = []
+        for i in range(0, len(runs), MERGE_FANIN):
+            fd, path = tempfile.mkstemp(dir=os.path.dirname(dest), suffix=".run")
+            os.close(fd)
+            _merge(runs[i : i + MERGE_FANIN], path, dead)
+            merged.append(path)
+        intermediate.extend(merged)
+        runs = merged
+    _merge(runs, dest, dead)
+    for path in intermediate:
+        os.remove(path)
+
+
+def extract_breach_emails(blocks, members):
+    """
+    Finds emails in the decompressed blocks of a breach file, like extract_emails() does.
+    Tar archives are read member by member, skipping tar headers, with line numbers starting over in each member
+    like the gzip search counts them. (name, data offset, size) of every member is appended to members.
+    Yields (email hash, member id, line number, line byte offset), member ids being positions in members plus one,
+    and 0 outside tar archives. Every block is read, so the content hash covers the whole file.
+    """
+    stream = block_stream(blocks)
+    if not is_tar(stream.peek(TAR_BLOCK)):
+        for key, line, offset in extract_emails(stream.chunks()):
+            yield key, 0, line, offset
+        return
+    for name, size in tar_members(stream):
+        members.append((name, stream.offset, size))
+        for key, line, offset in extract_emails(stream.chunks(size), stream.offset):
+            yield key, len(members), line, offset
+    stream.skip(None)
+
+
+def index_worker(file_id, filepath, run_dir):
+    """
+    Extracts every email of filepath and writes them as sorted run files of RUN_RECORDS records in run_dir.
+    Returns list of run files, number of records, content hash of filepath and its tar members.
+    """
+    try:
+        runs = []
+        records = []
+        count = 0
+        digest = hashlib.blake2b()
+        c.info_news(
+            "Worker [{PID}] is indexing {filepath} ({size:,.0f} MB)".format(
+                PID=os.getpid(),
+                filepath=filepath,
+                size=os.stat(filepath).st_size / float(1 << 20),
+            )
+        )
+        members = []
+        with open_breach(filepath) as fp:
+            for key, member, line, offset in extract_breach_emails(hashed_blocks(fp, digest), members):
+                records.append(RECORD.pack(key, file_id, member, line, offset))
+                if len(records) >= RUN_RECORDS:
+                    runs.append(write_run(records, run_dir))
+                    count += len(records)
+                    records = []
+        if records:
+            runs.append(write_run(records, run_dir))
+            count += len(records)
+        return runs, count, digest.hexdigest(), members
+    except Exception as e:
+        c.bad_news(f"Something went wrong with index worker for {filepath}")
+        print(e)
+
+
+def load_manifest(index_dir):
+    """
+    Returns the manifest of index_dir, or an empty one for a new index.
+    Manifest lists indexed files, their file id being their position, and the index segments.
+    An index built by another h8mail version gets an empty manifest, its files being indexed again.
+    """
+    try:
+        with open(os.path.join(index_dir, INDEX_MANIFEST)) as fp:
+            manifest = json.load(fp)
+    except FileNotFoundError:
+        return {"version": INDEX_VERSION, "files": [], "segments": [], "next_segment": 0}
+    if manifest.get("version", 1) == INDEX_VERSION:
+        return manifest
+    c.info_news(f"Index {index_dir} was built by another h8mail version, its files will be indexed again")
+    return {
+        "version": INDEX_VERSION,
+        "files": [],
+        "segments": [],
+        "next_segment": manifest["next_segment"],
+        "stale_segments": manifest["segments"],
+    }
+
+
+def save_manifest(index_dir, manifest):
+    """
+    Saves the manifest of index_dir, then removes the segments of the older index it replaces, if any
+    """
+    stale_segments = manifest.pop("stale_segments", [])
+    path = os.path.join(index_dir, INDEX_MANIFEST)
+    with open(path + ".tmp", "w") as fp:
+        json.dump(manifest, fp)
+    os.replace(path + ".tmp", path)
+    for s in stale_segments:
+        try:
+            os.remove(os.path.join(index_dir, s))
+        except FileNotFoundError:
+            pass
+
+
+def changed_files(manifest, files_to_index):
+    """
+    Compares files_to_index with the manifest using size and mtime, then content hash when only mtime changed.
+    Changed and vanished files are marked dead, new and changed files get a new file id.
+    Returns list of (file id, filepath) to index.
+    """
+    files = manifest["files"]
+    known = {f["path"]: file_id for file_id, f in enumerate(files) if f["live"]}
+    for path, file_id in known.items():
+        if not os.path.isfile(path):
+            c.info_news(f"Removing vanished {path} from index")
+            files[file_id]["live"] = False
+    to_index = []
+    for path in dict.fromkeys(os.path.abspath(f) for f in files_to_index):
+        st = os.stat(path)
+        if path in known and files[known[path]]["live"]:
+            entry = files[known[path]]
+            if entry["size"] == st.st_size and entry["mtime"] == st.st_mtime:
+                continue
+            if entry["size"] == st.st_size and entry["hash"] == content_hash(path):
+                entry["mtime"] = st.st_mtime
+                continue
+            c.info_news(f"Reindexing changed {path}")
+            entry["live"] = False
+        to_index.append((len(files), path))
+        files.append(
+            {"path": path, "size": st.st_size, "mtime": st.st_mtime, "hash": None, "live": True}
+        )
+    return to_index
+
+
+def new_segment(manifest):
+    name = "emails-{:04d}.idx".format(manifest["next_segment"])
+    manifest["next_segment"] += 1
+    return name
+
+
+def compact_index(index_dir, manifest):
+    """
+    Merges every segment of index_dir in a single one, dropping records of dead files
+    """
+    old_segments = manifest["segments"]
+    dead = [file_id for file_id, f in enumerate(manifest["files"]) if not f["live"]]
+    c.info_news(f"Compacting {len(old_segments)} index segments")
+    segment = new_segment(manifest)
+    merge_runs(
+        [os.path.join(index_dir, s) for s in old_segments],
+        os.path.join(index_dir, segment),
+        dead,
+    )
+    manifest["segments"] = [segment]
+    save_manifest(index_dir, manifest)
+    for s in old_segments:
+        os.remove(os.path.join(index_dir, s))
+
+
+def update_index(index_dir, files_to_index):
+    """
+    Updates the email index of index_dir with files_to_index, creating it if needed.
+    Only new or changed files are indexed, every file by a separate worker. Their runs are merged in a new
+    sorted segment. Segments are compacted once there are more than MAX_SEGMENTS.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    manifest = load_manifest(index_dir)
+    to_index = changed_files(manifest, files_to_index)
+    if len(to_index) == 0:
+        save_manifest(index_dir, manifest)
+        c.good_news(f"Index {index_dir} is up to date")
+        return
+    run_dir = tempfile.mkdtemp(dir=index_dir)
+    original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+    pool = Pool()
+    signal.signal(signal.SIGINT, original_sigint_handler)
+    runs = []
+    total = 0
+    try:
+        async_results = [
+            pool.apply_async(index_worker, args=(file_id, f, run_dir))
+            for file_id, f in to_index
+        ]
+        for (file_id, _), r in zip(to_index, async_results):
+            res = r.get()
+            if res is None:
+                manifest["files"][file_id]["live"] = False
+                continue
+            runs.extend(res[0])
+            total += res[1]
+            manifest["files"][file_id]["hash"] = res[2]
+            manifest["files"][file_id]["members"] = res[3]
+    except KeyboardInterrupt:
+        c.bad_news("Caught KeyboardInterrupt, terminating workers")
+        pool.terminate()
+        pool.join()
+        shutil.rmtree(run_dir)
+        return
+    else:
+        pool.close()
+    pool.join()
+    c.info_news(f"Merging {len(runs)} sorted runs")
+    segment = new_segment(manifest)
+    merge_runs(runs, os.path.join(run_dir, segment))
+    os.replace(os.path.join(run_dir, segment), os.path.join(index_dir, segment))
+    manifest["segments"].append(segment)
+    save_manifest(index_dir, manifest)
+    shutil.rmtree(run_dir)
+    c.good_news(
+        f"Indexed {total:,} emails from {len(to_index)} new or changed files in {index_dir}"
+    )
+    if len(manifest["segments"]) > MAX_SEGMENTS:
+        compact_index(index_dir, manifest)
+
+
+class index_segment:
+    """
+    Memory mapped sorted record file, searched by binary search over the email hash
+    """
+
+    def __init__(self, path):
+        self.fp = open(path, "rb")
+        size = os.fstat(self.fp.fileno()).st_size
+        self.count = size // RECORD.size
+        if size:
+            self.records = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.records = b""
+
+    def lookup(self, key):
+        """
+        Yields (file id, member id, line number, line byte offset) of every record of key
+        """
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.records[mid * RECORD.size : mid * RECORD.size + 8] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        while lo < self.count:
+            k, file_id, member, line, offset = RECORD.unpack_from(self.records, lo * RECORD.size)
+            if k != key:
+                break
+            yield file_id, member, line, offset
+            lo += 1
+
+    def close(self):
+        if self.count:
+            self.records.close()
+        self.fp.close()
+
+
+class local_index:
+    """
+    Read only view of an email index folder and its segments.
+    Records of dead files, changed or removed since indexing, are skipped.
+    """
+
+    def __init__(self, index_dir):
+        manifest = load_manifest(index_dir)
+        self.files = manifest["files"]
+        self.segments = [
+            index_segment(os.path.join(index_dir, s)) for s in manifest["segments"]
+        ]
+
+    def lookup(self, email):
+        """
+        Yields (filepath, line byte offset, line number, member name, member data end) for every indexed line
+        holding email. Member name and end are None outside tar archives
+        """
+        key = email_key(encode_target(email))
+        for segment in self.segments:
+            for file_id, member, line, offset in segment.lookup(key):
+                f = self.files[file_id]
+                if not f["live"]:
+                    continue
+                if member == 0:
+                    yield f["path"], offset, line, None, None
+                else:
+                    name, start, size = f["members"][member - 1]
+                    yield f["path"], offset, line, name, start + size
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+
+def local_index_search(index_dir, target_list):
+    """
+    Looks up every email of target_list in the index of index_dir.
+    Matching lines are read back from the breach files to check for hash collisions and changed files.
+    Hits of all targets are read together per file in offset order, so gzip files without seek index
+    are decompressed once instead of rewinding for every target.
+    Hits in tar archives are reported with their member, lines being cut at the end of the member data.
+    Return list of local_breach_targets objects to be tranformed in target objects.
+    """
+    found_list = []
+    index = local_index(index_dir)
+    hits = {}
+    fp = None
+    try:
+        for t in target_list:
+            if "@" not in t:
+                continue
+            for filepath, offset, line, member, end in index.lookup(t):
+                hits.setdefault(filepath, []).append((offset, line, t, member, end))
+        for filepath, file_hits in hits.items():
+            fp = open_breach_lines(filepath)
+            last = None
+            for offset, line, t, member, end in sorted(file_hits):
+                if offset != last:
+                    fp.seek(offset)
+                    content = fp.readline()
+                    if end is not None:
+                        content = content[: end - offset]
+                    last = offset
+                if normalize_email(encode_target(t)) not in content.lower():
+                    continue
+                found = found_targets(filepath, line, content, [t], member)
+                print_found(found)
+                found_list.extend(found)
+            fp.close()
+            fp = None
+    except Exception as e:
+        c.bad_news(f"Something went wrong searching index {index_dir}")
+        print(e)
+    finally:
+        if fp is not None:
+            fp.close()
+        index.close()
+    return found_list
@@ -5,108 +5,241 @@ import os
 import sys
 import signal
 
-from multiprocessing import Pool
-from itertools import takewhile, repeat
-from .classes import local_breach_target
+from multiprocessing import Pool, Queue
+from .classes import breach_record, local_breach_target
 from .colors import colors as c
+from .matcher import target_matcher, counted_blocks, read_blocks, read_range, scan_blocks
+
+CHUNK_SIZE = 256 << 20
+# Result queue and target matcher of pool workers, set by init_worker()
+_results = None
+_matcher = None
 
 
 def local_to_targets(targets, local_results, user_args):
     """
     Appends data from local_breach_target objects using existing list of targets.
-    Finds corresponding email in dest object list, and adds data to the t.data object variable.
-    Full output line is stored in t.data[1] and original found data in t.data[2]
+    Local results are grouped by target email in a single pass, then added in bulk to the t.data object variable.
+    Full output line is stored as the record value and original found data as its content
 
     """
+    found = {}
+    for l in local_results:
+        source = os.path.basename(l.filepath)
+        if l.member is not None:
+            source += f":{l.member}"
+        found.setdefault(l.target, []).append(
+            breach_record(
+                "LOCALSEARCH",
+                f"[{source}] Line {l.line}: {l.content}".strip(),
+                l.content.strip(),
+            )
+        )
+        if user_args.debug:
+            c.debug_news(f"DEBUG: Found following content matching {l.target}")
+            l.dump()
     for t in targets:
-        for l in local_results:
-            if l.target == t.target:
-                t.data.append(
-                    (
-                        "LOCALSEARCH",
-                        f"[{os.path.basename(l.filepath)}] Line {l.line}: {l.content}".strip(),
-                        l.content.strip(),
-                    )
-                )
-                t.pwned += 1
-                if user_args.debug:
-                    c.debug_news(f"DEBUG: Found following content matching {t.target.target}")
-                    l.target.dump()
+        if t.target in found:
+            t.data.extend(found[t.target])
+            t.pwned += len(found[t.target])
     return targets
 
 
-def raw_in_count(filename):
+def split_file(filepath, chunk_size=CHUNK_SIZE):
     """
-    StackOverflow trick to rapidly count lines in big files.
-    Returns total line number.
+    Splits filepath in newline aligned byte ranges of about chunk_size bytes, so a single big file can be
+    searched by every worker of the pool.
+    Returns list of (start, end) offsets. Files smaller than chunk_size, or chunk_size of 0, give a single range.
     """
-    c.info_news("Identifying total line number...")
-    f = open(filename, "rb")
-    bufgen = takewhile(lambda x: x, (f.raw.read(1024 * 1024) for _ in repeat(None)))
-    return sum(buf.count(b"\n") for buf in bufgen)
+    size = os.stat(filepath).st_size
+    if chunk_size <= 0 or size <= chunk_size:
+        return [(0, size)]
+    ranges = []
+    start = 0
+    with open(filepath, "rb") as fp:
+        while start < size:
+            end = start + chunk_size
+            if end < size:
+                fp.seek(end)
+                for block in read_blocks(fp, 1 << 16):
+                    newline = block.find(b"\n")
+                    if newline != -1:
+                        end += newline + 1
+                        break
+                    end += len(block)
+            end = min(end, size)
+            ranges.append((start, end))
+            start = end
+    return ranges
 
 
-def worker(filepath, target_list):
+def file_tasks(filepath, chunk_size=CHUNK_SIZE):
     """
-    Searches for every email from target_list in every line of filepath.
-    Attempts to decode line using cp437. If it fails, catch and use raw data
+    Returns the (filepath, start, end) search tasks of filepath, one per range of split_file().
+    Files that cannot be read are reported and get no task, so the other files are still searched
     """
     try:
+        return [(filepath, start, end) for start, end in split_file(filepath, chunk_size)]
+    except OSError as e:
+        c.bad_news(f"Could not read {filepath}, skipping it")
+        print(e)
+        return []
+
+
+def found_targets(filepath, cnt, line, targets, member=None):
+    """
+    Decodes a matching line using cp437 and returns one local_breach_target per target found in it.
+    """
+    decoded = str(line, "cp437")
+    return [local_breach_target(t, filepath, cnt, decoded, member) for t in targets]
+
+
+def print_found(found_list):
+    """
+    Prints each found local_breach_target once per line. Tar members are printed as archive:member
+    """
+    last = None
+    for f in found_list:
+        if (f.filepath, f.member, f.line) != last:
+            source = f.filepath if f.member is None else f"{f.filepath}:{f.member}"
+            c.good_news(f"Found occurrence [{source}] Line {f.line}: {f.content}")
+            last = (f.filepath, f.member, f.line)
+
+
+def init_worker(results, matcher):
+    """
+    Pool initializer, stores the result queue workers push found targets to, and the target matcher.
+    Both are handed once to each worker process instead of being pickled with every task.
+    """
+    global _results, _matcher
+    _results = results
+    _matcher = matcher
+
+
+def shared_matcher():
+    """
+    Returns the target matcher set by init_worker()
+    """
+    return _matcher
+
+
+def push_found(task_id, found_list):
+    _results.put(("found", task_id, found_list))
+
+
+def push_done(task_id, lines):
+    """
+    Signals task_id is done. lines is the line count of the searched range, None if the task failed
+    """
+    _results.put(("done", task_id, lines))
+
+
+def worker(task_id, filepath, start=0, end=None):
+    """
+    Searches for every target of the shared matcher in every line of filepath, between the start and end byte offsets.
+    File is scanned in raw blocks, only lines holding a target are decoded using cp437.
+    Found targets are pushed to the result queue as soon as found, with line numbers relative to start.
+    The line count of the range is pushed once done.
+    """
+    lines = None
+    try:
+        if end is None:
+            end = os.stat(filepath).st_size
+        c.info_news(
+            "Worker [{PID}] is searching for targets in {filepath} ({size:,.0f} MB at offset {start:,})".format(
+                PID=os.getpid(), filepath=filepath, size=(end - start) / float(1 << 20), start=start)
+            )
         with open(filepath, "rb") as fp:
-            found_list = []
-            size = os.stat(filepath).st_size
-            c.info_news(
-                "Worker [{PID}] is searching for targets in {filepath} ({size:,.0f} MB)".format(
-                    PID=os.getpid(), filepath=filepath, size=size / float(1 << 20))
-                )
-            for cnt, line in enumerate(fp):
-                for t in target_list:
-                    if t in str(line, "cp437"):
-                        try:
-                            decoded = str(line, "cp437")
-                            found_list.append(
-                                local_breach_target(t, filepath, cnt, decoded)
-                            )
-                            c.good_news(
-                                f"Found occurrence [{filepath}] Line {cnt}: {decoded}"
-                            )
-                        except Exception as e:
-                            c.bad_news(
-                                f"Got a decoding error line {cnt} - file: {filepath}"
-                            )
-                            c.good_news(
-                                f"Found occurrence [{filepath}] Line {cnt}: {line}"
-                            )
-                            found_list.append(
-                                local_breach_target(t, filepath, cnt, str(line))
-                            )
-        return found_list
+            fp.seek(start)
+            blocks = counted_blocks(read_range(fp, end - start))
+            for cnt, line, targets in scan_blocks(blocks, _matcher):
+                push_found(task_id, found_targets(filepath, cnt, line, targets))
+        lines = blocks.lines
     except Exception as e:
         c.bad_news("Something went wrong with worker")
         print(e)
+    finally:
+        push_done(task_id, lines)
+
+
+def offset_found(found_list, offset):
+    for f in found_list:
+        f.line += offset
+    print_found(found_list)
+    return found_list
+
 
+def merge_results(results, tasks):
+    """
+    Consumes the result queue until every task is done, yielding found local_breach_targets as they arrive.
+    Line numbers of a file range are offset by the line counts of the previous ranges of the same file,
+    its hits are held until those are known.
+    """
+    offsets = {}
+    lines = {}
+    held = {}
+    for task_id, args in enumerate(tasks):
+        if task_id == 0 or tasks[task_id - 1][0] != args[0]:
+            offsets[task_id] = 0
+    pending = len(tasks)
+    while pending:
+        kind, task_id, payload = results.get()
+        if kind == "found":
+            if task_id in offsets:
+                yield from offset_found(payload, offsets[task_id])
+            else:
+                held.setdefault(task_id, []).extend(payload)
+            continue
+        pending -= 1
+        lines[task_id] = payload or 0
+        while task_id in offsets and task_id in lines:
+            next_id = task_id + 1
+            if next_id == len(tasks) or next_id in offsets:
+                break
+            offsets[next_id] = offsets[task_id] + lines[task_id]
+            yield from offset_found(held.pop(next_id, []), offsets[next_id])
+            task_id = next_id
 
-def local_search(files_to_parse, target_list):
+
+def stream_search(search_worker, tasks, target_list):
+    """
+    Runs search_worker over every task in a worker pool. Tasks are argument tuples starting with a filepath.
+    The target matcher is built once and shared with every worker by the pool initializer.
+    Yields local_breach_targets objects as workers find them, without waiting for whole files.
+    """
+    results = Queue()
+    matcher = target_matcher(target_list)
     original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
-    pool = Pool()
-    found_list = []
+    pool = Pool(initializer=init_worker, initargs=(results, matcher))
     signal.signal(signal.SIGINT, original_sigint_handler)
     try:
-        async_results = [
-            pool.apply_async(worker, args=(f, target_list))
-            for i, f in enumerate(files_to_parse)
-        ]
-        for r in async_results:
-            if r.get() is not None:
-                found_list.extend(r.get(60))
+        for task_id, args in enumerate(tasks):
+            pool.apply_async(search_worker, args=(task_id,) + args)
+        yield from merge_results(results, tasks)
     except KeyboardInterrupt:
         c.bad_news("Caught KeyboardInterrupt, terminating workers")
-        pool.terminate()
     else:
         c.info_news("Terminating worker pool")
-        pool.close()
-    pool.join()
-    return found_list
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def iter_local_search(files_to_parse, target_list, chunk_size=CHUNK_SIZE):
+    """
+    Receives list of all files to check for target_list.
+    Big files are split in chunk_size byte ranges, and every range is searched by a separate worker of the pool.
+    Yields local_breach_targets objects to be tranformed in target objects, as soon as they are found.
+    """
+    tasks = [task for f in files_to_parse for task in file_tasks(f, chunk_size)]
+    return stream_search(worker, tasks, target_list)
+
+
+def local_search(files_to_parse, target_list, chunk_size=CHUNK_SIZE):
+    """
+    Return list of local_breach_targets objects found by iter_local_search()
+    """
+    return list(iter_local_search(files_to_parse, target_list, chunk_size))
 
 
 def progress(count, total, status=""):
@@ -123,38 +256,35 @@ def progress(count, total, status=""):
 sys.stdout.flush()
 
 
+def progress_blocks(fp, size):
+    """
+    Yields raw blocks from fp while updating the progress bar with the amount of bytes checked
+    """
+    checked = 0
+    for block in read_blocks(fp):
+        checked += len(block)
+        progress(
+            checked,
+            max(size, 1),
+            "{checked:,.0f} MB checked - {left:,.0f} MB left".format(
+                checked=checked / float(1 << 20),
+                left=(size - checked) / float(1 << 20),
+            ),
+        )
+        yield block
+
+
 def local_search_single(files_to_parse, target_list):
     found_list = []
+    matcher = target_matcher(target_list)
     for file_to_parse in files_to_parse:
         with open(file_to_parse, "rb") as fp:
             size = os.stat(file_to_parse).st_size
-            lines_no = raw_in_count(file_to_parse)
             c.info_news(
-                f"Searching for targets in {file_to_parse} ({size} bytes, {lines_no} lines)"
+                f"Searching for targets in {file_to_parse} ({size} bytes)"
             )
-            for cnt, line in enumerate(fp):
-                lines_left = lines_no - cnt
-                progress(
-                    cnt, lines_no, f"{cnt} lines checked - {lines_left} lines left"
-                )
-                for t in target_list:
-                    if t in str(line):
-                        try:
-                            decoded = str(line, "cp437")
-                            found_list.append(
-                                local_breach_target(t, file_to_parse, cnt, decoded)
-                            )
-                            c.good_news(
-                                f"Found occurrence [{file_to_parse}] Line {cnt}: {decoded}"
-                            )
-                        except:
-                            c.bad_news(
-                                f"Got a decoding error line {cnt} - file: {file_to_parse}"
-                            )
-                            c.good_news(
-                                f"Found occurrence [{file_to_parse}] Line {cnt}: {line}"
-                            )
-                            found_list.append(
-                                local_breach_target(t, file_to_parse, cnt, str(line))
-                            )
+            for cnt, line, targets in scan_blocks(progress_blocks(fp, size), matcher):
+                found = found_targets(file_to_parse, cnt, line, targets)
+                print_found(found)
+                found_list.extend(found)
     return found_list
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+import re
+import zlib
+
+BLOCK_SIZE = 4 << 20
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def encode_target(t):
+    """
+    Returns the raw bytes a target is searched as.
+    Lines are decoded as cp437 so targets are encoded the same way, utf-8 is used for unmappable targets.
+    """
+    try:
+        return t.encode("cp437")
+    except UnicodeEncodeError:
+        return t.encode("utf-8")
+
+
+def _common_prefix(a, b, start):
+    """
+    Returns the length of the common prefix of a and b, knowing they share the first start bytes
+    """
+    end = min(len(a), len(b))
+    while start < end and a[start] == b[start]:
+        start += 1
+    return start
+
+
+def _trie_regex(patterns):
+    """
+    Compiles a sorted list of distinct byte patterns into a single regex shaped like their trie.
+    Shared prefixes are factored out, so the regex engine only follows one branch per byte
+    instead of trying every target at every position.
+    Single child chains are emitted as literals to keep the nesting shallow.
+    """
+
+    def branch(lo, hi, depth):
+        # patterns[lo:hi] all share their first depth bytes
+        ends_here = len(patterns[lo]) == depth
+        if ends_here:
+            lo += 1
+        alternatives = []
+        i = lo
+        while i < hi:
+            byte = patterns[i][depth]
+            j = i + 1
+            while j < hi and patterns[j][depth] == byte:
+                j += 1
+            shared = _common_prefix(patterns[i], patterns[j - 1], depth + 1)
+            alternatives.append(
+                re.escape(patterns[i][depth:shared]) + branch(i, j, shared)
+            )
+            i = j
+        if not alternatives:
+            return b""
+        if len(alternatives) == 1 and not ends_here:
+            return alternatives[0]
+        return b"(?:" + b"|".join(alternatives) + (b")?" if ends_here else b")")
+
+    return re.compile(branch(0, len(patterns), 0))
+
+
+class target_matcher:
+    """
+    Multi-pattern matcher built once per search from the target list.
+    Targets are compiled in a trie shaped regex, letting the C regex engine find every line holding a target
+    in a single pass over raw bytes. Targets found at each match position are then resolved with
+    dictionary lookups, so the cost does not grow with the number of targets.
+    """
+
+    def __init__(self, target_list):
+        self.targets = []
+        self.patterns = {}
+        for t in dict.fromkeys(target_list):
+            raw = encode_target(t)
+            if not raw or b"\n" in raw:
+                continue
+            self.patterns.setdefault(raw, []).append(len(self.targets))
+            self.targets.append(t)
+        self.lengths = sorted({len(p) for p in self.patterns})
+        if self.patterns:
+            self.regex = _trie_regex(sorted(self.patterns))
+        else:
+            self.regex = None
+
+    def resolve(self, buf, pos, end):
+        """
+        Returns the targets found in buf[pos:end], in target list order.
+        """
+        found = set()
+        m = self.regex.search(buf, pos, end)
+        while m is not None:
+            start = m.start()
+            for length in self.lengths:
+                if start + length > end:
+                    break
+                idx = self.patterns.get(buf[start : start + length])
+                if idx is not None:
+                    found.update(idx)
+            m = self.regex.search(buf, start + 1, end)
+        return [self.targets[i] for i in sorted(found)]
+
+    def scan(self, buf, start=0, end=None, first_line=0):
+        """
+        Scans buf[start:end], which must hold whole lines.
+        Yields (line number, raw line, targets) for every line holding at least one target.
+        """
+        if self.regex is None:
+            return
+        if end is None:
+            end = len(buf)
+        line_no = first_line
+        counted = start
+        pos = start
+        while True:
+            m = self.regex.search(buf, pos, end)
+            if m is None:
+                return
+            line_start = buf.rfind(b"\n", start, m.start()) + 1 or start
+            line_end = buf.find(b"\n", m.end(), end)
+            line_end = end if line_end == -1 else line_end + 1
+            line_no += buf.count(b"\n", counted, line_start)
+            counted = line_start
+            yield line_no, buf[line_start:line_end], self.resolve(
+                buf, m.start(), line_end
+            )
+            pos = line_end
+
+
+def read_blocks(fp, size=BLOCK_SIZE):
+    """
+    Yields raw blocks of size bytes from a file object until EOF
+    """
+    return iter(lambda: fp.read(size), b"")
+
+
+def tee_blocks(blocks, filepath):
+    """
+    Yields blocks unchanged, writing them to filepath on the way
+    """
+    with open(filepath, "wb") as fp:
+        for block in blocks:
+            fp.write(block)
+            yield block
+
+
+def scan_blocks(blocks, matcher, first_line=0):
+    """
+    Scans an iterable of raw byte blocks for matcher targets.
+    Partial lines at the end of a block are carried over to the next one.
+    Yields (line number, raw line, targets) for every line holding at least one target.
+    """
+    line_no = first_line
+    carry = b""
+    for block in blocks:
+        buf = carry + block if carry else block
+        cut = buf.rfind(b"\n") + 1
+        if cut == 0:
+            carry = buf
+            continue
+        carry = buf[cut:]
+        yield from matcher.scan(buf, 0, cut, line_no)
+        line_no += buf.count(b"\n", 0, cut)
+    if carry:
+        yield from matcher.scan(carry, 0, len(carry), line_no)
+
+
+def read_range(fp, length, size=BLOCK_SIZE):
+    """
+    Yields raw blocks of fp, from its current position and up to length bytes
+    """
+    while length > 0:
+        block = fp.read(min(size, length))
+        if not block:
+            return
+        length -= len(block)
+        yield block
+
+
+def inflate_blocks(data_blocks, size=1 << 20):
+    """
+    Yields decompressed blocks of an iterable of raw gzip data blocks.
+    Decompressed blocks are capped to 8 times size. Concatenated gzip members are decompressed one after
+    the other, like zcat does.
+    """
+    decompressor = None
+    for data in data_blocks:
+        while data:
+            if decompressor is None:
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            block = decompressor.decompress(data, size << 3)
+            if block:
+                yield block
+            if decompressor.eof:
+                data = decompressor.unused_data
+                if data and not GZIP_MAGIC.startswith(data[:2]):
+                    return
+                decompressor = None
+            else:
+                data = decompressor.unconsumed_tail
+    if decompressor is None:
+        return
+    block = decompressor.flush()
+    if block:
+        yield block
+    if not decompressor.eof:
+        raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+
+
+def gzip_blocks(fp, size=1 << 20):
+    """
+    Yields decompressed blocks of a raw gzip file object, feeding zlib size bytes of compressed data at a time
+    """
+    return inflate_blocks(read_blocks(fp, size), size)
+
+
+class counted_blocks:
+    """
+    Iterates over an iterable of raw blocks, keeping count of bytes and lines.
+    Used to number lines of file ranges.
+    """
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.bytes = 0
+        self.lines = 0
+
+    def __iter__(self):
+        for block in self.blocks:
+            self.bytes += len(block)
+            self.lines += block.count(b"\n")
+            yield block
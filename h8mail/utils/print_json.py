@@ -6,11 +6,11 @@ def generate_source_arrays(pwned_data):
     data_array = []
     no_src = 0 # To check for data with no explicit source
     temp_array = []
-    for i in range(len(pwned_data)):
-        if len(pwned_data[i]) == 2:
-            temp_array.append(pwned_data[i][0] + ":" + pwned_data[i][1])
+    for r in pwned_data:
+        if r.content is None:
+            temp_array.append(r.label + ":" + str(r.value))
             no_src += 1
-            if "SOURCE" in pwned_data[i][0]:
+            if "SOURCE" in r.label:
                 data_array.append(temp_array)
                 temp_array = []
                 no_src = 0
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+from .colors import colors as c
+import importlib
+
+# Result types added by local sources, printed with those of the providers
+LOCAL_LABELS = ("LOCAL", "BC_PASS")
+
+
+def _resolve(path):
+    """
+    Returns the function of a "module:function" path, modules being relative to this package.
+    The function can be an attribute path such as "target.get_hibp3"
+    """
+    module, _, name = path.partition(":")
+    func = importlib.import_module(module, __package__)
+    for attr in name.split("."):
+        func = getattr(func, attr)
+    return func
+
+
+class provider:
+    """
+    Declares a service queried for every target, and what it needs to run.
+    keys are the config keys passed to the query in order, (key, default) pairs being optional keys.
+    With pass_config the whole config is passed instead, and with pass_query the query type is passed last.
+    queries are the supported query types, None for all of them.
+    Default providers need no key and are skipped by --skip-defaults. Their probe, if any, tells if the service is up.
+    rate (requests per second) and concurrency (requests at once) are the default limits of the service,
+    shared by every provider of the same service.
+    labels are the prefixes of the result types added to targets.
+    run is the "module:function" path of the query, called with the target and its arguments.
+    It is imported on first use, so unused providers cost nothing.
+    """
+
+    def __init__(
+        self,
+        name,
+        service,
+        run,
+        keys=(),
+        pass_config=False,
+        pass_query=False,
+        queries=("email",),
+        default=False,
+        probe=None,
+        rate=None,
+        concurrency=None,
+        labels=(),
+    ):
+        self.name = name
+        self.service = service
+        self.run_path = run
+        self.keys = keys
+        self.pass_config = pass_config
+        self.pass_query = pass_query
+        self.queries = queries
+        self.default = default
+        self.probe = probe
+        self.rate = rate
+        self.concurrency = concurrency
+        self.labels = labels
+        self._run = None
+        self._up = None
+
+    def supports(self, query):
+        return self.queries is None or query in self.queries
+
+    def args(self, api_keys, query):
+        """
+        Returns the arguments of the query from the config, or None when the provider is not configured
+        """
+        if self.default:
+            args = []
+        else:
+            required = [k for k in self.keys if isinstance(k, str)]
+            missing = [k for k in required if api_keys is None or k not in api_keys]
+            if len(missing) == len(required):
+                return None
+            if missing:
+                c.bad_news(f"Missing {', '.join(missing)} for {self.name}")
+                return None
+            if self.pass_config:
+                args = [api_keys]
+            else:
+                args = [
+                    api_keys[k] if isinstance(k, str) else api_keys.get(k[0], k[1])
+                    for k in self.keys
+                ]
+        if self.pass_query:
+            args.append(query)
+        return tuple(args)
+
+    def is_up(self):
+        """
+        Tells if the service is up, probing it once per run
+        """
+        if self._up is None:
+            self._up = self.probe is None or bool(_resolve(self.probe)())
+        return self._up
+
+    def run(self, t, args):
+        if self._run is None:
+            self._run = _resolve(self.run_path)
+        return self._run(t, *args)
+
+
+PROVIDERS = [
+    provider(
+        "hunterio_public",
+        "hunterio",
+        ".classes:target.get_hunterio_public",
+        default=True,
+        labels=("HUNTER_PUB",),
+    ),
+    provider(
+        "breachdirectory",
+        "breachdirectory",
+        ".classes:target.get_breachdirectory",
+        keys=("breachdirectory_user", "breachdirectory_pass"),
+        pass_query=True,
+        queries=("email", "username", "password", "domain"),
+        labels=("BREACHDR",),
+    ),
+    provider(
+        "hibp",
+        "hibp",
+        ".classes:target.get_hibp3",
+        keys=("hibp",),
+        rate=1 / 1.3,
+        concurrency=1,
+        labels=("HIBP",),
+    ),
+    # emailrep seems to insta-block h8mail user agent without a key
+    provider(
+        "emailrep",
+        "emailrep",
+        ".classes:target.get_emailrepio",
+        keys=("emailrep",),
+        rate=2.0,
+        labels=("EMAILREP",),
+    ),
+    provider(
+        "hunterio_private",
+        "hunterio",
+        ".classes:target.get_hunterio_private",
+        keys=("hunterio",),
+        labels=("HUNTER_RELATED",),
+    ),
+    provider(
+        "intelx",
+        "intelx",
+        ".classes:target.get_intelx",
+        keys=("intelx_key",),
+        pass_config=True,
+        queries=None,
+        concurrency=4,
+        labels=("INTELX",),
+    ),
+    provider(
+        "snusbase",
+        "snusbase",
+        ".classes:target.get_snusbase",
+        keys=(("snusbase_url", "http://api.snusbase.com/v2/search"), "snusbase_token"),
+        pass_query=True,
+        queries=None,
+        labels=("SNUS",),
+    ),
+    provider(
+        "leaklookup_priv",
+        "leaklookup",
+        ".classes:target.get_leaklookup_priv",
+        keys=("leak-lookup_priv",),
+        pass_query=True,
+        queries=None,
+        labels=("LKLP",),
+    ),
+    provider(
+        "leaklookup_pub",
+        "leaklookup",
+        ".classes:target.get_leaklookup_pub",
+        keys=("leak-lookup_pub",),
+        labels=("LEAKLOOKUP",),
+    ),
+    provider(
+        "weleakinfo_pub",
+        "weleakinfo",
+        ".classes:target.get_weleakinfo_pub",
+        keys=("weleakinfo_pub",),
+        rate=2.5,
+        labels=("WLI",),
+    ),
+    provider(
+        "weleakinfo_priv",
+        "weleakinfo",
+        ".classes:target.get_weleakinfo_priv",
+        keys=("weleakinfo_priv",),
+        pass_query=True,
+        queries=None,
+        rate=2.5,
+        labels=("WLI",),
+    ),
+    provider(
+        "dehashed",
+        "dehashed",
+        ".classes:target.get_dehashed",
+        keys=("dehashed_email", "dehashed_key"),
+        pass_query=True,
+        queries=None,
+        labels=("DHASHD",),
+    ),
+    provider(
+        "scylla",
+        "scylla",
+        ".classes:target.get_scylla",
+        default=True,
+        pass_query=True,
+        queries=None,
+        probe=".helpers:check_scylla_online",
+        rate=2.0,
+        labels=("SCYLLA",),
+    ),
+]
+
+
+def register_provider(p):
+    """
+    Adds a provider to the registry, after the built-in ones
+    """
+    PROVIDERS.append(p)
+
+
+def schedule(api_keys, query, skip_defaults=False):
+    """
+    Picks the providers to query for every target, in registry order.
+    Returns list of (provider, arguments)
+    """
+    queries = []
+    for p in PROVIDERS:
+        if not p.supports(query) or (p.default and skip_defaults):
+            continue
+        args = p.args(api_keys, query)
+        if args is None or not p.is_up():
+            continue
+        queries.append((p, args))
+    return queries
+
+
+def default_rates():
+    return {p.service: p.rate for p in PROVIDERS if p.rate is not None}
+
+
+def default_concurrency():
+    return {p.service: p.concurrency for p in PROVIDERS if p.concurrency is not None}
+
+
+def result_labels():
+    """
+    Returns the result type prefixes printed in results, of every provider and local source
+    """
+    labels = []
+    for p in PROVIDERS:
+        labels.extend(l for l in p.labels if l not in labels)
+    return tuple(labels) + LOCAL_LABELS
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+from .colors import colors as c
+from .providers import default_concurrency, default_rates
+from threading import BoundedSemaphore, Lock
+import time
+
+RATE_UNITS = {"s": 1, "m": 60, "min": 60, "h": 3600}
+
+# Requests per second allowed for each provider and API key, and requests sent at once per provider.
+# Defaults are declared by the provider registry
+_rates = default_rates()
+_concurrency = default_concurrency()
+_slots = {}
+_buckets = {}
+_holds = {}
+_buckets_lock = Lock()
+
+
+class token_bucket:
+    """
+    Thread safe token bucket, refilled with rate tokens per second up to burst tokens.
+    Callers reserve their token and sleep outside the lock, so waiting callers are served in turn.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        """
+        Takes a token, sleeping only when the bucket is empty
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+def parse_rate(value):
+    """
+    Returns requests per second from a config rate, either a number of requests per second or
+    requests per unit such as "10/m". Units are s, m (or min) and h
+    """
+    count, _, unit = value.strip().partition("/")
+    unit = unit.strip() or "s"
+    if unit not in RATE_UNITS:
+        raise ValueError(f"unknown rate unit {unit}")
+    return float(count) / RATE_UNITS[unit]
+
+
+def configure_rates(api_keys):
+    """
+    Reads the rate_<provider> keys of the config, such as rate_hibp = 10/m. A rate of 0 disables rate limiting.
+    Reads the concurrency_<provider> keys, the number of requests sent at once. 0 removes the limit.
+    Providers without keys use the defaults of the provider registry.
+    """
+    if api_keys is None:
+        return
+    for k in api_keys:
+        if len(api_keys[k]) == 0:
+            continue
+        try:
+            if k.startswith("rate_"):
+                _rates[k[len("rate_") :]] = parse_rate(api_keys[k])
+            elif k.startswith("concurrency_"):
+                _concurrency[k[len("concurrency_") :]] = int(api_keys[k])
+        except ValueError as e:
+            c.bad_news(f"Invalid {k} configuration key")
+            print(e)
+    with _buckets_lock:
+        _buckets.clear()
+        _holds.clear()
+        _slots.clear()
+
+
+def hold(provider, key, delay):
+    """
+    Makes every request of provider with key wait delay seconds from now, such as asked by a Retry-After header
+    """
+    until = time.monotonic() + delay
+    with _buckets_lock:
+        _holds[(provider, key)] = max(_holds.get((provider, key), 0), until)
+
+
+def wait_turn(provider, key=""):
+    """
+    Waits until provider can be queried with key, one token bucket being kept per provider and key.
+    Held providers are waited for first
+    """
+    with _buckets_lock:
+        until = _holds.get((provider, key), 0)
+    wait = until - time.monotonic()
+    if wait > 0:
+        time.sleep(wait)
+    rate = _rates.get(provider)
+    if not rate:
+        return
+    with _buckets_lock:
+        bucket = _buckets.get((provider, key))
+        if bucket is None:
+            bucket = _buckets[(provider, key)] = token_bucket(rate)
+    bucket.acquire()
+
+
+def concurrency_limit(provider):
+    """
+    Returns the number of requests provider can be sent at once, or None without limit
+    """
+    return _concurrency.get(provider) or None
+
+
+class request_slot:
+    """
+    Context manager holding one of the concurrent request slots of provider, if its concurrency is limited
+    """
+
+    def __init__(self, provider):
+        self.semaphore = None
+        limit = _concurrency.get(provider)
+        if limit:
+            with _buckets_lock:
+                self.semaphore = _slots.get(provider)
+                if self.semaphore is None:
+                    self.semaphore = _slots[provider] = BoundedSemaphore(limit)
+
+    def __enter__(self):
+        if self.semaphore is not None:
+            self.semaphore.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        if self.semaphore is not None:
+            self.semaphore.release()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from .colors import colors as c
+from email.utils import parsedate_to_datetime
+from threading import Lock
+import datetime
+import random
+
+# Status codes of throttled or temporarily failing services
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Attempts made for a single request, the first one included
+MAX_ATTEMPTS = 4
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+# Longer Retry-After delays are not waited for, the response is kept as is
+RETRY_AFTER_MAX = 300.0
+# Retries allowed per provider for the whole run
+DEFAULT_BUDGET = 50
+
+_budgets = {}
+_budgets_lock = Lock()
+_default_budget = DEFAULT_BUDGET
+
+
+def configure_retries(api_keys):
+    """
+    Reads the retry_<provider> keys of the config, the number of retries allowed per provider for the run.
+    A budget of 0 disables retries. Providers without retry key get DEFAULT_BUDGET retries
+    """
+    with _budgets_lock:
+        _budgets.clear()
+        if api_keys is None:
+            return
+        for k in api_keys:
+            if not k.startswith("retry_") or len(api_keys[k]) == 0:
+                continue
+            try:
+                _budgets[k[len("retry_") :]] = int(api_keys[k])
+            except ValueError as e:
+                c.bad_news(f"Invalid {k} configuration key")
+                print(e)
+
+
+def retry_after(response):
+    """
+    Returns the seconds to wait from the Retry-After header of response, given in seconds or as an HTTP date.
+    Returns None without valid header
+    """
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def backoff_delay(attempt):
+    """
+    Exponential backoff with full jitter: a random delay up to BACKOFF_BASE * 2^attempt, capped to BACKOFF_MAX
+    """
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def retry_delay(provider, attempt, response=None):
+    """
+    Tells if the request of provider should be sent again after its attempt (0 for the first one) failed,
+    either with response or, when response is None, without reaching the service.
+    Returns the seconds to wait before the next attempt, or None to give up.
+    Every retry takes one from the provider budget.
+    """
+    if attempt + 1 >= MAX_ATTEMPTS:
+        return None
+    delay = None
+    if response is not None:
+        if response.status_code not in RETRY_STATUSES:
+            return None
+        delay = retry_after(response)
+        if delay is not None and delay > RETRY_AFTER_MAX:
+            return None
+    with _budgets_lock:
+        budget = _budgets.get(provider, _default_budget)
+        if budget <= 0:
+            return None
+        _budgets[provider] = budget - 1
+        if budget == 1:
+            c.bad_news(f"Retry budget of {provider} is spent, failing requests will not be retried")
+    if delay is None:
+        delay = backoff_delay(attempt)
+    return delay
@@ -6,6 +6,7 @@ import os
 import re
 import time
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 from .breachcompilation import breachcomp_check
 from .classes import target
@@ -18,11 +19,17 @@ from .helpers import (
     print_banner,
     save_results_csv,
     check_latest_version,
-    check_scylla_online,
 )
 from .print_json import save_results_json
-from .localsearch import local_search, local_search_single, local_to_targets
-from .localgzipsearch import local_gzip_search, local_search_single_gzip
+from .providers import schedule
+from .ratelimit import configure_rates
+from .retry import configure_retries
+from .cache import configure_cache
+from .intelx_helpers import add_intelx_targets, configure_intelx
+from .sessions import POOL_SIZE, configure_sessions
+from .localsearch import iter_local_search, local_search_single, local_to_targets
+from .localgzipsearch import iter_local_gzip_search, local_search_single_gzip
+from .localindex import update_index, local_index_search
 from .summary import print_summary
 from .chase import chase
 from .print_results import print_results
@@ -30,11 +37,61 @@ from .gen_config import gen_config_file
 from .url import target_urls
 
 
+def query_worker(t, debug, p, args):
+    """
+    Launches a single provider query on a new target object, so providers of a same target can run concurrently.
+    Returns the target object holding this query results
+    """
+    result = target(t, debug=debug)
+    p.run(result, args)
+    return result
+
+
+def merge_target(current_target, result):
+    """
+    Adds the data found by a query_worker() target object to current_target
+    """
+    current_target.data.extend(result.data)
+    current_target.pwned += result.pwned
+
+
+def query_targets(targets, queries, debug, executor=None):
+    """
+    Launches every query on every target, and yields the target objects in targets order.
+    With an executor, all queries of all targets are submitted at once, and results are added
+    to each target in the same order as a sequential run.
+    """
+    futures = {}
+    try:
+        if executor is not None:
+            for t in targets:
+                futures[t] = [
+                    executor.submit(query_worker, t, debug, p, args)
+                    for p, args in queries
+                ]
+        for t in targets:
+            c.info_news("Target factory started for {target}".format(target=t))
+            current_target = target(t, debug=debug)
+            if executor is None:
+                for p, args in queries:
+                    p.run(current_target, args)
+            else:
+                for f in futures[t]:
+                    merge_target(current_target, f.result())
+            yield current_target
+    finally:
+        for target_futures in futures.values():
+            for f in target_futures:
+                f.cancel()
+
+
 def target_factory(targets, user_args):
     """
     Receives list of emails and user args. Fetchs API keys from config file using user_args path and cli keys.
-    For each target, launch target.methods() associated to found config artifacts.
-    Handles chase logic with counters from enumerate()
+    For each target, launch the providers of the registry associated to found config artifacts.
+    With more than one worker, provider queries are run by a thread pool.
+    Chased targets are queried breadth first: every chase level goes through the same pipeline as the targets,
+    up to the --chase depth and --chase-budget targets. A target is never queried twice.
     """
     # Removing duplicates here to avoid dups from chasing
     targets = list(set(targets))
@@ -44,87 +101,55 @@ def target_factory(targets, user_args):
         api_keys = get_config_from_file(user_args)
     else:
         api_keys = None
-    init_targets_len = len(targets)
+    configure_rates(api_keys)
+    configure_retries(api_keys)
+    configure_cache(user_args, api_keys)
+    configure_intelx(user_args, api_keys)
 
     query = "email"
-    skip_default_queries = False
     if user_args.user_query is not None:
         query = user_args.user_query
-        skip_default_queries = True  # custom query skips default query automatically
-
-    scylla_up = False
-    if user_args.skip_defaults is False:
-        scylla_up = check_scylla_online()
-
-    for counter, t in enumerate(targets):
-        c.info_news("Target factory started for {target}".format(target=t))
-        if user_args.debug:
-            current_target = target(t, debug=True)
-        else:
-            current_target = target(t)
-        if not skip_default_queries:
-            if not user_args.skip_defaults:
-                current_target.get_hunterio_public()
-                ## emailrep seems to insta-block h8mail user agent without a key
-                # if api_keys is None or "emailrep" not in api_keys:
-                #     current_target.get_emailrepio()
-                # elif (
-                #     api_keys is not None and "emailrep" in api_keys and query == "email"
-                # ):
-                #     current_target.get_emailrepio(api_keys["emailrep"])
-
-        if api_keys is not None:
-            if (
-                "breachdirectory_user" in api_keys
-                and "breachdirectory_pass" in api_keys
+
+    queries = schedule(api_keys, query, user_args.skip_defaults)
+    # Chased targets are emails
+    chase_queries = queries
+    if user_args.chase_limit and query != "email":
+        chase_queries = schedule(api_keys, "email", user_args.skip_defaults)
+
+    seen = {t.lower() for t in targets}
+    chase_budget = user_args.chase_budget
+    if chase_budget is None and user_args.chase_limit:
+        # --chase alone keeps chasing its number of emails per target
+        chase_budget = user_args.chase_limit * len(targets)
+    depth = 0
+    executor = None
+    if user_args.workers > 1:
+        executor = ThreadPoolExecutor(max_workers=user_args.workers)
+    try:
+        while targets:
+            add_intelx_targets(targets)
+            chased = []
+            for current_target in query_targets(
+                targets, chase_queries if depth else queries, user_args.debug, executor
             ):
-                current_target.get_breachdirectory(
-                    api_keys["breachdirectory_user"], api_keys["breachdirectory_pass"], query
-                )
-            if "hibp" in api_keys and query == "email":
-                current_target.get_hibp3(api_keys["hibp"])
-            if "emailrep" in api_keys and query == "email":
-                current_target.get_emailrepio(api_keys["emailrep"])
-            if "hunterio" in api_keys and query == "email":
-                current_target.get_hunterio_private(api_keys["hunterio"])
-            if "intelx_key" in api_keys:
-                current_target.get_intelx(api_keys)
-            if "snusbase_token" in api_keys:
-                if "snusbase_url" in api_keys:
-                    snusbase_url = api_keys["snusbase_url"]
-                else:
-                    snusbase_url = "http://api.snusbase.com/v2/search"
-                current_target.get_snusbase(
-                    snusbase_url, api_keys["snusbase_token"], query
-                )
-            if "leak-lookup_priv" in api_keys:
-                current_target.get_leaklookup_priv(api_keys["leak-lookup_priv"], query)
-            if "leak-lookup_pub" in api_keys and query == "email":
-                current_target.get_leaklookup_pub(api_keys["leak-lookup_pub"])
-            if "weleakinfo_pub" in api_keys and query == "email":
-                current_target.get_weleakinfo_pub(api_keys["weleakinfo_pub"])
-            if "weleakinfo_priv" in api_keys:
-                current_target.get_weleakinfo_priv(api_keys["weleakinfo_priv"], query)
-            if "dehashed_key" in api_keys:
-                if "dehashed_email" in api_keys:
-                    current_target.get_dehashed(
-                        api_keys["dehashed_email"], api_keys["dehashed_key"], query
-                    )
-                else:
-                    c.bad_news("Missing Dehashed email")
-        if scylla_up:
-            current_target.get_scylla(query)
-
-        # Chasing
-        if user_args.chase_limit and counter <= init_targets_len:
-            user_args_force_email = user_args
-            user_args_force_email.user_query = "email"
-            user_args_force_email.chase_limit -= 1
-            finished_chased = target_factory(
-                chase(current_target, user_args), user_args_force_email
-            )
-            finished.extend((finished_chased))
-        finished.append(current_target)
+                finished.append(current_target)
+                if not user_args.chase_limit or depth >= user_args.chase_limit:
+                    continue
+                for t in chase(current_target, user_args):
+                    if t.lower() in seen:
+                        continue
+                    if chase_budget is not None and chase_budget <= 0:
+                        c.info_news(f"Chase budget spent, not chasing {t}")
+                        continue
+                    seen.add(t.lower())
+                    chased.append(t)
+                    if chase_budget is not None:
+                        chase_budget -= 1
+            targets = chased
+            depth += 1
+    finally:
+        if executor is not None:
+            executor.shutdown()
     return finished
 
 
@@ -144,6 +169,7 @@ def h8mail(user_args):
         exit(1)
 
     start_time = time.time()
+    configure_sessions(max(POOL_SIZE, user_args.workers))
 
     import warnings
 
@@ -192,26 +218,39 @@ def h8mail(user_args):
         breached_targets = breachcomp_check(breached_targets, user_args.bc_path)
 
     local_found = None
+    scan_targets = targets
+    # Handle email index search. Local sources are merged in the index, and only scanned for the targets it does not hold
+    if user_args.local_index:
+        files_to_index = local_index_sources(user_args)
+        if len(files_to_index) != 0:
+            update_index(user_args.local_index, files_to_index)
+        index_targets = indexed_targets(targets, user_args)
+        scan_targets = [t for t in targets if t not in index_targets]
+        if len(index_targets) != 0:
+            local_found = local_index_search(user_args.local_index, index_targets)
+            breached_targets = local_to_targets(breached_targets, local_found, user_args)
+        if len(scan_targets) != 0 and len(files_to_index) == 0:
+            c.info_news("Only emails are indexed. Use --local-breach or --gzip to search other targets")
     # Handle cleartext search
-    if user_args.local_breach_src:
+    if user_args.local_breach_src and len(scan_targets) != 0:
         for arg in user_args.local_breach_src:
             res = find_files(arg)
             if user_args.single_file:
-                local_found = local_search_single(res, targets)
+                local_found = local_search_single(res, scan_targets)
             else:
-                local_found = local_search(res, targets)
+                local_found = iter_local_search(res, scan_targets, user_args.chunk_size << 20)
             if local_found is not None:
                 breached_targets = local_to_targets(
                     breached_targets, local_found, user_args
                 )
     # Handle gzip search
-    if user_args.local_gzip_src:
+    if user_args.local_gzip_src and len(scan_targets) != 0:
         for arg in user_args.local_gzip_src:
             res = find_files(arg, "gz")
             if user_args.single_file:
-                local_found = local_search_single_gzip(res, targets)
+                local_found = local_search_single_gzip(res, scan_targets)
             else:
-                local_found = local_gzip_search(res, targets)
+                local_found = iter_local_gzip_search(res, scan_targets, user_args.chunk_size << 20)
             if local_found is not None:
                 breached_targets = local_to_targets(
                     breached_targets, local_found, user_args
@@ -225,6 +264,41 @@ def h8mail(user_args):
     if user_args.output_json:
         save_results_json(user_args.output_json, breached_targets)
 
+
+def indexed_targets(targets, user_args):
+    """
+    Returns the targets looked up in the email index: emails, unless searching loosely or with a custom query
+    """
+    if user_args.loose or user_args.user_query not in (None, "email"):
+        return []
+    return [t for t in targets if "@" in t]
+
+
+def local_index_sources(user_args):
+    """
+    Returns the files of the --local-breach and --gzip sources, to be merged in the email index
+    """
+    files_to_index = []
+    if user_args.local_breach_src:
+        for arg in user_args.local_breach_src:
+            files_to_index.extend(find_files(arg))
+    if user_args.local_gzip_src:
+        for arg in user_args.local_gzip_src:
+            files_to_index.extend(find_files(arg, "gz"))
+    return files_to_index
+
+
+def build_local_index(user_args):
+    """
+    Builds or updates the email index of the --local-breach and --gzip sources in the --build-index folder
+    """
+    files_to_index = local_index_sources(user_args)
+    if len(files_to_index) == 0:
+        c.bad_news("No breach files to index. Use --local-breach or --gzip")
+        exit(1)
+    update_index(user_args.build_index, files_to_index)
+
+
 def parse_args(args):
     """
     Seperate functions to make it easier to run tests
@@ -278,7 +352,7 @@ def parse_args(args):
         "-bc",
         "--breachcomp",
         dest="bc_path",
-        help="Path to the breachcompilation torrent folder. Uses the query.sh script included in the torrent",
+        help="Path to the breachcompilation torrent folder. Data files are searched directly like the query.sh script included in the torrent does, every data file by a separate process",
     )
     parser.add_argument(
         "-sk",
@@ -299,16 +373,36 @@ def parse_args(args):
         "-lb",
         "--local-breach",
         dest="local_breach_src",
-        help="Local cleartext breaches to scan for targets. Uses multiprocesses, one separate process per file, on separate worker pool by arguments. Supports file or folder as input, and filepath globing",
+        help="Local cleartext breaches to scan for targets. Uses multiprocesses, one separate process per file or per --chunk-size range of big files, on separate worker pool by arguments. Supports file or folder as input, and filepath globing",
         nargs="+",
     )
     parser.add_argument(
         "-gz",
         "--gzip",
         dest="local_gzip_src",
-        help="Local tar.gz (gzip) compressed breaches to scans for targets. Uses multiprocesses, one separate process per file. Supports file or folder as input, and filepath globing. Looks for 'gz' in filename",
+        help="Local tar.gz (gzip) compressed breaches to scans for targets. Uses multiprocesses, one separate process per file or per --chunk-size segment of big indexed files. Tar archives are searched member by member and results show archive:member. Supports file or folder as input, and filepath globing. Looks for 'gz' in filename",
         nargs="+",
     )
+    parser.add_argument(
+        "-cs",
+        "--chunk-size",
+        dest="chunk_size",
+        help="Size in MB of the ranges big cleartext breaches are split in, so a single file is searched by every worker process. Big gzip breaches get a seek index saved next to them with a seek point every chunk size of decompressed data, so later searches are also split. Use 0 to search each file with a single process. Defaults to 256",
+        type=int,
+        default=256,
+    )
+    parser.add_argument(
+        "-ib",
+        "--build-index",
+        dest="build_index",
+        help="Builds or updates a persistent email index of the --local-breach and --gzip sources in this folder & exits. Only new or changed files are indexed. Use with --index to query it instead of scanning breaches",
+    )
+    parser.add_argument(
+        "-ix",
+        "--index",
+        dest="local_index",
+        help="Email index folder built with --build-index. Targets are looked up in the index instead of scanning the indexed breaches. New or changed --local-breach and --gzip files are merged in the index first. Only email targets are indexed, other targets are searched by scanning the --local-breach and --gzip sources",
+    )
     parser.add_argument(
         "-sf",
         "--single-file",
@@ -317,14 +411,42 @@ def parse_args(args):
         action="store_true",
         default=False,
     ),
+    parser.add_argument(
+        "-w",
+        "--workers",
+        dest="workers",
+        help="Number of threads running target queries concurrently. Every service of every target is queried in parallel, results are added in the same order. Keep-alive HTTP connections kept per service grow with workers, from 10. Defaults to 1, querying sequentially. Pages of --url are fetched with at least 8 threads",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="no_cache",
+        help="Do not use the local cache of service responses. By default, responses are kept in ~/.cache/h8mail/responses.sqlite, for a time set per service, and reused by the next runs",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--refresh",
+        dest="refresh_cache",
+        help="Query services again instead of using cached responses, and update the cache with the new responses",
+        action="store_true",
+        default=False,
+    )
     parser.add_argument(
         "-ch",
         "--chase",
         dest="chase_limit",
-        help="Add related emails from hunter.io to ongoing target list. Define number of emails per target to chase. Requires hunter.io private API key if used without power-chase",
+        help="Add related emails from hunter.io to ongoing target list. Define number of emails per target to chase. Emails found for chased targets are chased too, up to this depth. Use --chase-budget to chase more emails. Requires hunter.io private API key if used without power-chase",
         type=int,
         nargs="?",
     ),
+    parser.add_argument(
+        "--chase-budget",
+        dest="chase_budget",
+        help="Maximum number of chased targets for the whole run, over all chase levels. Each related email is chased once. Defaults to the --chase number of emails per target",
+        type=int,
+    ),
     parser.add_argument(
         "--power-chase",
         dest="power_chase",
@@ -368,4 +490,7 @@ def main():
     if user_args.gen_config:
         gen_config_file()
         exit(0)
+    if user_args.build_index:
+        build_local_index(user_args)
+        exit(0)
     h8mail(user_args)
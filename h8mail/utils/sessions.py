@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from threading import Lock
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+# Default number of keep-alive connections kept open per host
+POOL_SIZE = 10
+
+_sessions = {}
+_sessions_lock = Lock()
+_pool_size = POOL_SIZE
+
+
+def configure_sessions(pool_size):
+    """
+    Sets the number of keep-alive connections kept per host by sessions created from now on
+    """
+    global _pool_size
+    _pool_size = max(1, pool_size)
+
+
+def get_session(url):
+    """
+    Returns the shared session of the scheme and host of url.
+    Sessions are created on first use, with a connection pool reusing connections across targets and providers
+    """
+    parts = urlsplit(url)
+    host = (parts.scheme, parts.netloc.lower())
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=_pool_size)
+            session.mount(parts.scheme + "://", adapter)
+            _sessions[host] = session
+    return session
+
+
+def http_request(method, url, **kwargs):
+    """
+    Same as requests.request(), sent through the shared session of url host
+    """
+    return get_session(url).request(method=method, url=url, **kwargs)
+
+
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
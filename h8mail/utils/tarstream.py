@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+import tarfile
+
+TAR_BLOCK = 512
+
+
+class block_stream:
+    """
+    Reads an iterable of decompressed blocks as a stream, keeping track of the offset and number of lines read
+    """
+
+    def __init__(self, blocks, offset=0, lines=0):
+        self.blocks = iter(blocks)
+        self.buf = b""
+        self.offset = offset
+        self.lines = lines
+
+    def peek(self, size):
+        while len(self.buf) < size:
+            block = next(self.blocks, b"")
+            if not block:
+                break
+            self.buf += block
+        return self.buf[:size]
+
+    def chunks(self, size=None):
+        """
+        Yields the next size bytes of the stream in blocks, or every remaining block when size is None
+        """
+        while size is None or size > 0:
+            if not self.buf:
+                self.buf = next(self.blocks, b"")
+                if not self.buf:
+                    return
+            if size is None or len(self.buf) <= size:
+                piece, self.buf = self.buf, b""
+            else:
+                piece, self.buf = self.buf[:size], self.buf[size:]
+            if size is not None:
+                size -= len(piece)
+            self.offset += len(piece)
+            self.lines += piece.count(b"\n")
+            yield piece
+
+    def read(self, size):
+        return b"".join(self.chunks(size))
+
+    def skip(self, size):
+        for _ in self.chunks(size):
+            pass
+
+
+def is_tar(header):
+    """
+    Tells if header is the first header of a POSIX or GNU tar archive
+    """
+    if len(header) < TAR_BLOCK or header[257:262] != b"ustar":
+        return False
+    try:
+        tarfile.TarInfo.frombuf(header[:TAR_BLOCK], tarfile.ENCODING, "surrogateescape")
+    except tarfile.HeaderError:
+        return False
+    return True
+
+
+def _pax_records(buf):
+    """
+    Returns the records of a pax extended header as a dict of raw keys and values
+    """
+    records = {}
+    pos = 0
+    while pos < len(buf):
+        space = buf.find(b" ", pos)
+        if space == -1:
+            break
+        try:
+            length = int(buf[pos:space])
+        except ValueError:
+            break
+        if length <= 0:
+            break
+        key, _, value = buf[space + 1 : pos + length - 1].partition(b"=")
+        records[key] = value
+        pos += length
+    return records
+
+
+def tar_members(stream):
+    """
+    Walks the headers of a tar archive stream.
+    Yields (name, size) of every regular file member, the stream being positioned at the start of its data.
+    Member data the caller leaves unread is skipped when resumed.
+    GNU long names and pax path and size records are supported.
+    """
+    name = None
+    size = None
+    while True:
+        header = stream.read(TAR_BLOCK)
+        if len(header) < TAR_BLOCK:
+            return
+        try:
+            info = tarfile.TarInfo.frombuf(header, tarfile.ENCODING, "surrogateescape")
+        except tarfile.HeaderError:
+            return
+        data_size = info.size if size is None else size
+        end = stream.offset + -(-data_size // TAR_BLOCK) * TAR_BLOCK
+        if info.type == tarfile.GNUTYPE_LONGNAME:
+            name = stream.read(data_size).rstrip(b"\0").decode(
+                tarfile.ENCODING, "surrogateescape"
+            )
+        elif info.type == tarfile.XHDTYPE:
+            records = _pax_records(stream.read(data_size))
+            if b"path" in records:
+                name = records[b"path"].decode("utf-8", "surrogateescape")
+            if b"size" in records:
+                size = int(records[b"size"])
+        elif info.type != tarfile.XGLTYPE:
+            if info.isreg():
+                yield name or info.name, data_size
+            name = None
+            size = None
+        stream.skip(end - stream.offset)
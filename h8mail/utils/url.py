@@ -1,15 +1,29 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import codecs
 import os
 import re
-import requests
+from concurrent.futures import ThreadPoolExecutor
 
 from .colors import colors as c
+from .sessions import http_request
 from .version import __version__
 from .helpers import get_emails_from_file
 from .helpers import fetch_emails
 
+# Minimum number of URLs fetched at once, raised by --workers
+URL_WORKERS = 8
+# Connect and read timeouts, in seconds
+URL_TIMEOUT = (10, 30)
+# Bytes read at most per page, larger pages are searched up to this size
+URL_MAX_SIZE = 16 << 20
+URL_CHUNK_SIZE = 64 << 10
+# Longest partial email carried over from a chunk to the next
+EMAIL_OVERLAP = 1024
+EMAIL_PATTERN = re.compile(r"[\w\.-]+@[\w\.-]+")
+BROWSER_UA = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/79.0.3945.88 Safari/537.36"
+
 def fetch_urls(target):
     """
     Returns a list of URLs found in 'target'.
@@ -47,25 +61,69 @@ def get_urls_from_file(targets_file):
 
 
 
+def _email_char(ch):
+    return ch.isalnum() or ch in "_.-@"
+
+
+def scan_emails(chunks, encoding=None):
+    """
+    Yields the emails found in an iterable of raw byte chunks, decoded incrementally.
+    The characters of a possibly partial email at the end of a chunk are carried over to the next one.
+    """
+    decoder = codecs.getincrementaldecoder(encoding or "utf-8")(errors="replace")
+    carry = ""
+    for chunk in chunks:
+        text = carry + decoder.decode(chunk)
+        cut = len(text)
+        while cut > 0 and len(text) - cut < EMAIL_OVERLAP and _email_char(text[cut - 1]):
+            cut -= 1
+        yield from EMAIL_PATTERN.findall(text, 0, cut)
+        carry = text[cut:]
+    yield from EMAIL_PATTERN.findall(carry + decoder.decode(b"", final=True))
+
+
+def capped_chunks(response, max_size=None):
+    """
+    Yields the body chunks of a streamed response, up to max_size bytes, URL_MAX_SIZE by default
+    """
+    if max_size is None:
+        max_size = URL_MAX_SIZE
+    size = 0
+    for chunk in response.iter_content(URL_CHUNK_SIZE):
+        if size + len(chunk) > max_size:
+            c.info_news(f"Page larger than {max_size >> 20} MB, searched up to this size: {response.url}")
+            yield chunk[: max_size - size]
+            return
+        size += len(chunk)
+        yield chunk
+
+
 def worker_url(url):
     """
-    Fetches the URL without the h8mail UA
+    Fetches the URL with a browser UA instead of the h8mail UA, and searches its body for emails while it downloads.
+    Returns the list of distinct emails found, or None
     """
-    paramsUA = {"User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/79.0.3945.88 Safari/537.36"}
     try:
         c.info_news("Worker fetching " + url)
-        r = requests.get(url, params = paramsUA, allow_redirects=False)
-        c.info_news("Worker done fetch url")
-        print(f"Status code: {r.status_code}")
-    
-        e = re.findall(r"[\w\.-]+@[\w\.-]+", r.text)
-        print(e)
+        r = http_request(
+            "GET",
+            url,
+            headers={"User-Agent": BROWSER_UA},
+            allow_redirects=False,
+            timeout=URL_TIMEOUT,
+            stream=True,
+        )
+        try:
+            e = list(dict.fromkeys(scan_emails(capped_chunks(r), r.encoding)))
+        finally:
+            r.close()
+        c.info_news(f"Worker done fetch url {url}, status code: {r.status_code}")
         if e:
             print(", ".join(e), c.reset)
             return e
         return None
     except Exception as ex:
-        c.bad_news("URL fetch worker error:")
+        c.bad_news(f"URL fetch worker error for {url}:")
         print(ex)
 
 
@@ -73,13 +131,14 @@ def target_urls(user_args):
     """
     For each user input with --url, check if its a file.
     If yes open and parse each line with regexp, else parse the input with regexp directly.
-    Parse html pages from URLs for email patterns.
-    Returns list of email targets
+    Parse html pages from URLs for email patterns. Pages are fetched concurrently, with --workers threads
+    and at least URL_WORKERS.
+    Returns list of distinct email targets, in URL order
     """
     try:
         c.info_news("Starting URL fetch")
         urls = []
-        emails = []
+        emails = {}
         for arg in user_args.user_urls:
             if os.path.isfile(arg):
                 e = get_urls_from_file(arg)
@@ -89,17 +148,20 @@ def target_urls(user_args):
                 continue
             else:
                 urls.extend(e)
-        
-        for url in urls:
-            e = worker_url(url)
-            # e = get_emails_from_file(tmpfile, user_args)
-            if e is None:
-                continue
-            else:
-                emails.extend(e)
+        urls = list(dict.fromkeys(urls))
+        if len(urls) == 0:
+            return []
 
-        return emails
+        workers = min(len(urls), max(URL_WORKERS, user_args.workers))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for e in executor.map(worker_url, urls):
+                # e = get_emails_from_file(tmpfile, user_args)
+                if e is None:
+                    continue
+                else:
+                    emails.update(dict.fromkeys(e))
+
+        return list(emails)
     except Exception as ex:
         c.bad_news("URL fetch error:")
         print(ex)
-
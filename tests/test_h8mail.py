@@ -13,12 +13,30 @@ import contextlib
 import os
 import tarfile
 import gzip
+import io
 import argparse
+import json
+import requests
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from h8mail.utils import run
 from h8mail.utils import classes
 from h8mail.utils import helpers
 from h8mail.utils import localsearch
 from h8mail.utils import localgzipsearch
+from h8mail.utils import localindex
+from h8mail.utils import gzipindex
+from h8mail.utils import breachcompilation
+from h8mail.utils import ratelimit
+from h8mail.utils import cache
+from h8mail.utils import retry
+from h8mail.utils import providers
+from h8mail.utils import intelx
+from h8mail.utils import intelx_helpers
+from h8mail.utils import matcher
+from h8mail.utils import url
 
 def print_test_banner(testname):
     print("========================")
@@ -28,6 +46,39 @@ def print_test_banner(testname):
     print("========================")
 
 
+class quiet_handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def body_handler(body):
+    """
+    Returns a request handler answering every GET with body
+    """
+
+    class handler(quiet_handler):
+        def do_GET(self):
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(body)
+
+    return handler
+
+
+@contextlib.contextmanager
+def local_server(handler):
+    """
+    Serves handler on a free local port from a daemon thread, and yields the root URL of the server
+    """
+    server = HTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield "http://127.0.0.1:{}".format(server.server_port)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
 def make_temp_directory():
     emails = """
     john.smith@gmail.com
@@ -73,12 +124,19 @@ class TestH8mail(unittest.TestCase):
         self.filetxt = os.path.join(self.temp_dir, "test-creds.txt")
         self.filegz = os.path.join(self.temp_dir, "test-creds.tar.gz")
         print("Test files generated in : " + self.temp_dir)
+        # Response cache and intelx.io file store of runs are kept in the temp dir, not in the user cache
+        self.xdg_cache_home = os.environ.get("XDG_CACHE_HOME")
+        os.environ["XDG_CACHE_HOME"] = os.path.join(self.temp_dir, "cache-home")
 
         # a = open(self.filetxt, "r")
         # print(a.readlines())
 
     def tearDown(self):
         """Cleaning temp files"""
+        if self.xdg_cache_home is None:
+            del os.environ["XDG_CACHE_HOME"]
+        else:
+            os.environ["XDG_CACHE_HOME"] = self.xdg_cache_home
         print("Removing dir + content: " + self.temp_dir)
         shutil.rmtree(self.temp_dir)
 
@@ -90,6 +148,64 @@ class TestH8mail(unittest.TestCase):
         user_args = run.parse_args(["-t", "test@example.com"])
         run.h8mail(user_args)
 
+    def test_001_local_matcher(self):
+        """Local search results and line numbers"""
+        print_test_banner("LOCAL MATCHER")
+        targets = ["john.smith@gmail.com", "test@evilcorp.com", "notfound@email.com"]
+        expected = [("john.smith@gmail.com", 1), ("test@evilcorp.com", 4)]
+        found = localsearch.local_search([self.filetxt], targets)
+        self.assertEqual(sorted((f.target, f.line) for f in found), expected)
+        found = localsearch.local_search([self.filetxt], targets, chunk_size=16)
+        self.assertEqual(sorted((f.target, f.line) for f in found), expected)
+        found = localsearch.local_search_single([self.filetxt], targets)
+        self.assertEqual(sorted((f.target, f.line) for f in found), expected)
+        found = localgzipsearch.local_search_single_gzip([self.filegz], targets)
+        self.assertEqual(sorted((f.target, f.line) for f in found), expected)
+        self.assertIn("SecretPASS", found[0].content)
+        self.assertTrue(found[0].member.endswith("test-creds.txt"))
+        found = localgzipsearch.local_gzip_search([self.filegz], targets)
+        self.assertEqual(sorted((f.target, f.line) for f in found), expected)
+        filemembers = os.path.join(self.temp_dir, "test-members.gz")
+        with open(self.filetxt, "rb") as fd_creds:
+            creds = fd_creds.read()
+        with open(filemembers, "wb") as fd_members:
+            fd_members.write(gzip.compress(creds[:40]) + gzip.compress(creds[40:]))
+        found = localgzipsearch.local_gzip_search([filemembers], targets)
+        self.assertEqual(sorted((f.target, f.line) for f in found), expected)
+
+    def test_001_merge_out_of_order(self):
+        """Line numbers of file ranges finishing out of order"""
+        print_test_banner("MERGE OUT OF ORDER")
+        tasks = [("a.txt", 0, 10), ("a.txt", 10, 20), ("a.txt", 20, 30), ("b.txt", 0, 5)]
+
+        def found(filepath, line):
+            return [classes.local_breach_target("test@example.com", filepath, line, "test@example.com:pass")]
+
+        results = queue.Queue()
+        for message in [
+            ("found", 2, found("a.txt", 1)),
+            ("done", 2, 5),
+            ("found", 1, found("a.txt", 2)),
+            ("found", 3, found("b.txt", 4)),
+            ("done", 3, 10),
+            ("found", 0, found("a.txt", 3)),
+            ("done", 1, 4),
+            ("done", 0, 7),
+        ]:
+            results.put(message)
+        merged = [(f.filepath, f.line) for f in localsearch.merge_results(results, tasks)]
+        # Ranges of a.txt start at lines 0, 7 and 11. Hits of later ranges are held until then
+        self.assertEqual(merged, [("b.txt", 4), ("a.txt", 3), ("a.txt", 9), ("a.txt", 12)])
+        self.assertTrue(results.empty())
+
+    def test_001_unreadable_file(self):
+        """Unreadable breach files skipped by local search"""
+        print_test_banner("UNREADABLE FILE")
+        broken = os.path.join(self.temp_dir, "broken.txt")
+        os.symlink(os.path.join(self.temp_dir, "missing.txt"), broken)
+        found = localsearch.local_search([broken, self.filetxt], ["test@evilcorp.com"])
+        self.assertEqual([(f.filepath, f.line) for f in found], [(self.filetxt, 4)])
+
     def test_002_local_files_txt_gz(self):
         """Local file search Test"""
         run.print_banner()
@@ -117,3 +233,491 @@ class TestH8mail(unittest.TestCase):
         print_test_banner("URL-MESSY")
         user_args_lb = run.parse_args(["-u", "https://raw.githubusercontent.com/khast3x/h8mail/master/tests/test_email.txt"])
         run.h8mail(user_args_lb)
+
+    def test_004_local_index(self):
+        """Email index build and lookup"""
+        print_test_banner("LOCAL INDEX")
+        index_dir = os.path.join(self.temp_dir, "index")
+        localindex.update_index(index_dir, [self.filetxt])
+        found = localindex.local_index_search(
+            index_dir, ["John.Smith@gmail.com", "test@evilcorp.com", "notfound@email.com"]
+        )
+        self.assertEqual(
+            sorted((f.target, f.line) for f in found),
+            [("John.Smith@gmail.com", 1), ("test@evilcorp.com", 4)],
+        )
+        self.assertIn("An0therSECRETpassw0rd", found[1].content)
+        with open(self.filetxt, "a") as fd_creds:
+            fd_creds.write("notfound@email.com:NewPASS\n")
+        user_args = run.parse_args(
+            ["-t", self.filetargets, "-ix", index_dir, "-lb", self.filetxt, "-sk"]
+        )
+        run.h8mail(user_args)
+        found = localindex.local_index_search(index_dir, ["notfound@email.com"])
+        self.assertEqual([f.line for f in found], [6])
+        self.assertEqual(len(localindex.load_manifest(index_dir)["segments"]), 2)
+        # Plus addresses and quoted emails are indexed whole
+        fileplus = os.path.join(self.temp_dir, "test-plus.txt")
+        with open(fileplus, "w") as fd_plus:
+            fd_plus.write("john+tag@gmail.com:pw\nmail='o'brien@example.com'\n")
+        localindex.update_index(index_dir, [fileplus])
+        found = localindex.local_index_search(index_dir, ["john+tag@gmail.com", "tag@gmail.com", "o'brien@example.com"])
+        self.assertEqual(sorted((f.target, f.line) for f in found), [("john+tag@gmail.com", 0), ("o'brien@example.com", 1), ("tag@gmail.com", 0)])
+        # Indexes of older versions are rebuilt
+        manifest = localindex.load_manifest(index_dir)
+        manifest["version"] = 1
+        localindex.save_manifest(index_dir, manifest)
+        localindex.update_index(index_dir, [fileplus])
+        self.assertEqual(localindex.load_manifest(index_dir)["segments"], ["emails-0003.idx"])
+        self.assertEqual(sorted(os.listdir(index_dir)), ["emails-0003.idx", "manifest.json"])
+        # Gzip lines are read in offset order, whatever the target order
+        filegz = os.path.join(self.temp_dir, "test-creds.txt.gz")
+        with open(self.filetxt, "rb") as fd_creds, gzip.open(filegz, "wb") as fd_gz:
+            fd_gz.write(fd_creds.read())
+        localindex.update_index(index_dir, [filegz])
+        found = localindex.local_index_search(index_dir, ["notfound@email.com", "test@evilcorp.com", "John.Smith@gmail.com"])
+        self.assertEqual([f.line for f in found if f.filepath == filegz], [1, 4, 6])
+        # Tar archives are indexed member by member, like the gzip search reads them
+        filetar = os.path.join(self.temp_dir, "test-members.tar.gz")
+        with tarfile.open(filetar, "w:gz") as tar:
+            for name, content in [("m0.txt", b"x@y.com:pass0\nfiller\n"), ("m1.txt", b"a\nb\nc\nhit@target.com:pass1")]:
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+        localindex.update_index(index_dir, [filetar])
+        tar_targets = ["x@y.com", "hit@target.com"]
+        scanned = localgzipsearch.local_gzip_search([filetar], tar_targets)
+        found = localindex.local_index_search(index_dir, tar_targets)
+        self.assertEqual(
+            sorted((f.target, f.member, f.line, f.content) for f in found if f.filepath == filetar),
+            sorted((f.target, f.member, f.line, f.content) for f in scanned),
+        )
+        self.assertEqual(sorted((f.member, f.line) for f in scanned), [("m0.txt", 0), ("m1.txt", 3)])
+        # Custom queries are not indexed, the breaches are scanned instead
+        output = os.path.join(self.temp_dir, "out.json")
+        user_args = run.parse_args(
+            ["-t", "An0therSECRETpassw0rd", "-q", "password", "-ix", index_dir, "-lb", self.filetxt, "-sk", "-j", output]
+        )
+        run.h8mail(user_args)
+        with open(output) as fd_json:
+            self.assertEqual(json.load(fd_json)["targets"][0]["pwn_num"], 1)
+
+    def test_005_gzip_seek_index(self):
+        """Gzip seek index build and parallel segment search"""
+        print_test_banner("GZIP SEEK INDEX")
+        filebig = os.path.join(self.temp_dir, "test-big.gz")
+        lines = ["user{0}@example.com:{1}".format(i, "x" * (i % 50)) for i in range(100000)]
+        lines[12345] = "test@evilcorp.com:An0therSECRETpassw0rd"
+        lines[98765] = "john.smith@gmail.com:SecretPASS"
+        with gzip.open(filebig, "wt") as fd_big:
+            fd_big.write("\n".join(lines) + "\n")
+        targets = ["john.smith@gmail.com", "test@evilcorp.com"]
+        expected = [("john.smith@gmail.com", 98765), ("test@evilcorp.com", 12345)]
+        found = localgzipsearch.local_gzip_search([filebig], targets, chunk_size=1 << 18)
+        self.assertEqual(sorted((f.target, f.line) for f in found), expected)
+        # Seek indexes, finished or left by an interrupted save, are not breach files
+        open(gzipindex.seek_index_path(filebig) + ".tmp", "wb").close()
+        self.assertEqual(sorted(helpers.find_files(self.temp_dir, "gz")), [filebig, self.filegz])
+        if not gzipindex.can_build_seek_index():
+            return
+        self.assertGreater(len(localgzipsearch.gzip_tasks(filebig, 1 << 18)), 1)
+        found = localgzipsearch.local_gzip_search([filebig], targets, chunk_size=1 << 18)
+        self.assertEqual(sorted((f.target, f.line) for f in found), expected)
+        reader = gzipindex.gzip_seek_reader(filebig, gzipindex.load_seek_index(filebig))
+        reader.seek(sum(len(l) + 1 for l in lines[:98765]))
+        self.assertEqual(reader.readline(), b"john.smith@gmail.com:SecretPASS\n")
+        reader.close()
+
+    def test_006_breachcompilation(self):
+        """BreachCompilation data files lookup"""
+        print_test_banner("BREACHCOMPILATION")
+        data_dir = os.path.join(self.temp_dir, "bc", "data")
+        os.makedirs(os.path.join(data_dir, "j", "o"))
+        with open(os.path.join(data_dir, "j", "o", "h"), "w") as fd_shard:
+            fd_shard.write("john.doe@gmail.com:pass1\njohn.smith@gmail.com:pass2\nJohn.Smith@gmail.com:SecretPASS\njohnny@gmail.com:pass3\n")
+        with open(os.path.join(data_dir, "t"), "w") as fd_shard:
+            fd_shard.write("test@evilcorp.com:An0therSECRETpassw0rd\n")
+        self.assertIsNone(breachcompilation.shard_path(data_dir, "notfound@email.com"))
+        targets = [classes.target(t) for t in ["john.smith@gmail.com", "test@evilcorp.com", "notfound@email.com"]]
+        breachcompilation.breachcomp_check(targets, os.path.join(self.temp_dir, "bc"))
+        self.assertEqual([d[1] for d in targets[0].data if d and d[0] == "BC_PASS"], ["pass2", "SecretPASS"])
+        self.assertEqual([d[1] for d in targets[1].data if d and d[0] == "BC_PASS"], ["An0therSECRETpassw0rd"])
+        self.assertEqual(targets[2].pwned, 0)
+        # Locale sorted shard ignoring dots, sorted at every sampled line but not in byte order
+        lines = ["john{:05d}@gmail.com:pass".format(i) for i in range(20000)] + ["john.smith@gmail.com:SecretPASS"]
+        lines.sort(key=lambda l: l.replace(".", "").lower())
+        with open(os.path.join(data_dir, "j", "o", "h"), "w") as fd_shard:
+            fd_shard.write("\n".join(lines) + "\n")
+        with open(os.path.join(data_dir, "j", "o", "h"), "rb") as fd_shard:
+            self.assertTrue(breachcompilation._samples_sorted(fd_shard.read()))
+        for _ in range(2):
+            targets = [classes.target("john.smith@gmail.com")]
+            breachcompilation.breachcomp_check(targets, os.path.join(self.temp_dir, "bc"))
+            self.assertEqual([d[1] for d in targets[0].data], ["SecretPASS"])
+        shard = os.path.join(data_dir, "j", "o", "h")
+        self.assertFalse(breachcompilation.load_sorted_shards()[shard][2])
+        self.assertEqual(breachcompilation.shard_lookup(shard, ["john00001@gmail.com"], True), ({"john00001@gmail.com": [b"john00001@gmail.com:pass"]}, True))
+
+    def test_007_rate_limit(self):
+        """Per provider and key rate limiting"""
+        print_test_banner("RATE LIMIT")
+        self.assertEqual(ratelimit.parse_rate("10/m"), 10 / 60)
+        self.assertEqual(ratelimit.parse_rate("2"), 2.0)
+        ratelimit.configure_rates({"rate_test": "20", "rate_hibp": ""})
+        start = time.monotonic()
+        for _ in range(3):
+            ratelimit.wait_turn("test", "key1")
+        ratelimit.wait_turn("test", "key2")
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_008_response_cache(self):
+        """Provider response cache, expiry and eviction"""
+        print_test_banner("RESPONSE CACHE")
+        self.assertEqual(cache.parse_duration("12h"), 43200)
+        store = cache.response_cache(os.path.join(self.temp_dir, "cache", "responses.sqlite"), {"small": 1}, max_size=40)
+        self.assertEqual(os.stat(os.path.join(self.temp_dir, "cache")).st_mode & 0o777, 0o700)
+        self.assertEqual(os.stat(os.path.join(self.temp_dir, "cache", "responses.sqlite")).st_mode & 0o777, 0o600)
+        found = requests.models.Response()
+        found.status_code, found.url, found._content = 200, "https://example.com/?key=secret", b'[{"Name": "Adobe"}]'
+        store.put("hibp", "breachedaccount", "Test@Example.com", found)
+        cached = store.get("hibp", "breachedaccount", "test@example.com")
+        self.assertEqual(cached.json(), [{"Name": "Adobe"}])
+        self.assertNotIn("secret", cached.url)
+        self.assertIsNone(store.get("hibp", "pasteaccount", "test@example.com"))
+        error = requests.models.Response()
+        error.status_code, error.url, error._content = 429, "https://example.com/", b""
+        store.put("hibp", "pasteaccount", "test@example.com", error)
+        self.assertIsNone(store.get("hibp", "pasteaccount", "test@example.com"))
+        store.put("small", "email", "short@example.com", found)
+        time.sleep(1.1)
+        self.assertIsNone(store.get("small", "email", "short@example.com"))
+        store.put("dehashed", "email", "other@example.com", found)
+        store.put("dehashed", "email", "last@example.com", found)
+        self.assertIsNone(store.get("hibp", "breachedaccount", "test@example.com"))
+        self.assertIsNotNone(store.get("dehashed", "email", "last@example.com"))
+        store.refresh = True
+        self.assertIsNone(store.get("dehashed", "email", "last@example.com"))
+        store.refresh = False
+        store.put("snusbase", "password", "Hunter2", found)
+        self.assertIsNone(store.get("snusbase", "password", "hunter2"))
+        self.assertIsNotNone(store.get("snusbase", "password", "Hunter2"))
+        store.close()
+
+    def test_008_rejected_responses(self):
+        """Error answers given in successful responses are not cached"""
+        print_test_banner("REJECTED RESPONSES")
+        hits = []
+
+        class quota_handler(quiet_handler):
+            def do_POST(self):
+                hits.append(self.path)
+                self.send_response(200)
+                self.end_headers()
+                if self.path == "/quota":
+                    self.wfile.write(b'{"error": "true", "message": "REQUEST LIMIT REACHED"}')
+                else:
+                    self.wfile.write(b'{"error": "false", "message": []}')
+
+        cache.configure_cache(run.parse_args(["-t", "test@example.com"]), {"cache_file": os.path.join(self.temp_dir, "responses.sqlite")})
+        try:
+            with local_server(quota_handler) as root:
+                for path in ["/quota", "/quota", "/found", "/found"]:
+                    classes.target("test@example.com").make_request(
+                        root + path, meth="POST", provider="leaklookup", query_type=path, valid=classes.leaklookup_answered
+                    )
+        finally:
+            cache.configure_cache(run.parse_args(["-t", "test@example.com", "--no-cache"]), None)
+        self.assertEqual(hits, ["/quota", "/quota", "/found"])
+
+    def test_009_retry(self):
+        """Provider requests retried with backoff and Retry-After"""
+        print_test_banner("RETRY")
+        statuses = [429, 503, 200]
+
+        class throttled_handler(quiet_handler):
+            def do_GET(self):
+                self.send_response(statuses.pop(0))
+                self.send_header("Retry-After", "0")
+                self.end_headers()
+                self.wfile.write(b"{}")
+
+        with local_server(throttled_handler) as root:
+            retry.configure_retries({"retry_test": "1"})
+            self.assertEqual(classes.target("test@example.com").make_request(root, provider="test").status_code, 503)
+            self.assertEqual(statuses, [200])
+            self.assertEqual(classes.target("test@example.com").make_request(root, provider="test").status_code, 200)
+            retry.configure_retries(None)
+            statuses.extend([429, 502, 200])
+            self.assertEqual(classes.target("test@example.com").make_request(root, provider="test").status_code, 200)
+        retry.configure_retries(None)
+        response = requests.models.Response()
+        response.status_code = 429
+        response.headers["Retry-After"] = "Wed, 21 Oct 2015 07:28:00 GMT"
+        self.assertEqual(retry.retry_after(response), 0)
+        response.headers["Retry-After"] = "3600"
+        self.assertIsNone(retry.retry_delay("test", 0, response))
+        self.assertLessEqual(retry.backoff_delay(3), 8)
+
+    def test_010_provider_registry(self):
+        """Providers picked from the registry by config keys and query type"""
+        print_test_banner("PROVIDER REGISTRY")
+        api_keys = {"hibp": "k1", "snusbase_token": "k2", "dehashed_key": "k3", "breachdirectory_user": "u", "breachdirectory_pass": "p"}
+        scheduled = [(p.name, args) for p, args in providers.schedule(api_keys, "email", skip_defaults=True)]
+        self.assertEqual(scheduled, [
+            ("breachdirectory", ("u", "p", "email")),
+            ("hibp", ("k1",)),
+            ("snusbase", ("http://api.snusbase.com/v2/search", "k2", "email")),
+        ])
+        scheduled = [p.name for p, _ in providers.schedule(api_keys, "hash", skip_defaults=True)]
+        self.assertEqual(scheduled, ["snusbase"])
+        self.assertEqual(providers.schedule(None, "email", skip_defaults=True), [])
+        self.assertIn("SNUS", providers.result_labels())
+        self.assertEqual(providers.default_rates()["hibp"], 1 / 1.3)
+
+    def test_010_concurrent_queries(self):
+        """Provider queries run by workers, results added in sequential order"""
+        print_test_banner("CONCURRENT QUERIES")
+        fast_done = {}
+        overlapped = []
+
+        def slow_query(t, key):
+            # Only returns early when the fast query of the target ran meanwhile
+            overlapped.append(fast_done.setdefault(t.target, threading.Event()).wait(5))
+            t.data.append(("SLOW", t.target))
+            t.pwned += 1
+
+        def fast_query(t, key):
+            t.data.extend([("FAST", t.target), ("FAST_SOURCE", "fast")])
+            t.pwned += 2
+            fast_done.setdefault(t.target, threading.Event()).set()
+
+        providers.register_provider(providers.provider("slow", "slow", "test", keys=("slow",)))
+        providers.PROVIDERS[-1]._run = slow_query
+        providers.register_provider(providers.provider("fast", "fast", "test", keys=("fast",)))
+        providers.PROVIDERS[-1]._run = fast_query
+        try:
+            user_args = run.parse_args(["-t", "a@example.com", "-w", "4", "-sk", "-k", "slow=1,fast=1", "--no-cache"])
+            finished = run.target_factory(["a@example.com", "b@example.com"], user_args)
+        finally:
+            del providers.PROVIDERS[-2:]
+        self.assertEqual(overlapped, [True, True])
+        self.assertEqual(sorted(t.target for t in finished), ["a@example.com", "b@example.com"])
+        for t in finished:
+            self.assertEqual([tuple(r) for r in t.data], [("SLOW", t.target), ("FAST", t.target), ("FAST_SOURCE", "fast")])
+            self.assertEqual(t.pwned, 3)
+
+    def test_011_chase(self):
+        """Breadth first chase, each related email queried once"""
+        print_test_banner("CHASE")
+        related = {
+            "a@example.com": ["b@example.com", "c@example.com"],
+            "b@example.com": ["a@example.com", "c@example.com", "d@example.com"],
+            "c@example.com": ["B@example.com", "e@example.com"],
+        }
+        queried = []
+
+        def related_query(t, key):
+            queried.append(t.target)
+            for email in related.get(t.target, []):
+                t.data.append(("HUNTER_RELATED", email))
+
+        providers.register_provider(providers.provider("related", "related", "test", keys=("related",)))
+        providers.PROVIDERS[-1]._run = related_query
+        try:
+            user_args = run.parse_args(["-t", "a@example.com", "-ch", "2", "--chase-budget", "10", "-sk", "-k", "related=1", "--no-cache"])
+            finished = run.target_factory(["a@example.com"], user_args)
+            self.assertEqual(queried[0], "a@example.com")
+            self.assertEqual(sorted(queried), ["a@example.com", "b@example.com", "c@example.com", "d@example.com", "e@example.com"])
+            self.assertEqual(len(finished), 5)
+            queried.clear()
+            user_args = run.parse_args(["-t", "a@example.com", "-ch", "2", "--chase-budget", "2", "-w", "4", "-sk", "-k", "related=1", "--no-cache"])
+            run.target_factory(["a@example.com"], user_args)
+            self.assertEqual(queried, ["a@example.com", "b@example.com", "c@example.com"])
+            # Without budget, --chase keeps its number of emails per target
+            queried.clear()
+            user_args = run.parse_args(["-t", "a@example.com", "-ch", "1", "-sk", "-k", "related=1", "--no-cache"])
+            run.target_factory(["a@example.com"], user_args)
+            self.assertEqual(queried, ["a@example.com", "b@example.com"])
+        finally:
+            providers.PROVIDERS.pop()
+
+    def test_012_coalesced_requests(self):
+        """Same domain requests sent once per run"""
+        print_test_banner("COALESCED REQUESTS")
+        hits = []
+
+        class count_handler(quiet_handler):
+            def do_GET(self):
+                hits.append(self.path)
+                time.sleep(0.2)
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(b'{"data": {"total": 3}}')
+
+        cache.configure_cache(run.parse_args(["-t", "test@example.com", "--no-cache"]), None)
+
+        with local_server(count_handler) as root:
+
+            def count(t):
+                return classes.target(t).make_request(root + "/count", provider="test", query_type="email-count", term=t.split("@")[1], coalesce=True)
+
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                responses = list(executor.map(count, ["a@example.com", "b@example.com", "c@Example.com", "d@example.org"]))
+        self.assertEqual(len(hits), 2)
+        self.assertEqual([r.json()["data"]["total"] for r in responses], [3, 3, 3, 3])
+
+    def test_013_breach_data(self):
+        """Target results kept in order with a value index"""
+        print_test_banner("BREACH DATA")
+        t = classes.target("test@example.com")
+        self.assertEqual(len(t.data), 0)
+        t.data.append(("HIBP3", "Adobe"))
+        t.data.append(classes.breach_record("LOCALSEARCH", "[breach.txt] Line 1: test@example.com:pass", "test@example.com:pass"))
+        t.data.extend([("SNUS_RELATED", "other@example.com"), ("HUNTER_PUB", 3)])
+        self.assertFalse(t.not_exists("other@example.com"))
+        self.assertTrue(t.not_exists("missing@example.com"))
+        self.assertEqual([r.label for r in t.data], ["HIBP3", "LOCALSEARCH", "SNUS_RELATED", "HUNTER_PUB"])
+        self.assertEqual(tuple(t.data[0]), ("HIBP3", "Adobe"))
+        self.assertEqual(len(t.data[1]), 3)
+        csv_path = os.path.join(self.temp_dir, "out.csv")
+        helpers.save_results_csv(csv_path, [t])
+        with open(csv_path) as fd_csv:
+            self.assertEqual(fd_csv.read().splitlines(), ["Target,Type,Data", "test@example.com,HIBP3,Adobe", "test@example.com,SNUS_RELATED,other@example.com", "test@example.com,HUNTER_PUB,3"])
+
+    def test_014_intelx_stream(self):
+        """intelx.io files searched while downloading"""
+        print_test_banner("INTELX STREAM")
+        body = b"first line\nleak test@example.com:pass1\nother@example.com:pass2\ntest@example.com:pass3"
+        client = intelx.intelx(key="test")
+        kept = os.path.join(self.temp_dir, "intelx.txt")
+        with local_server(body_handler(body)) as client.API_ROOT:
+            blocks = matcher.tee_blocks(client.FILE_STREAM("id", chunk_size=7), kept)
+            found = [(cnt, line) for cnt, line, _ in matcher.scan_blocks(blocks, matcher.target_matcher(["test@example.com"]))]
+        self.assertEqual(found, [(1, b"leak test@example.com:pass1\n"), (3, b"test@example.com:pass3")])
+        with open(kept, "rb") as fd_kept:
+            self.assertEqual(fd_kept.read(), body)
+
+    def test_015_intelx_credits(self):
+        """intelx.io file reads counted against the key credits"""
+        print_test_banner("INTELX CREDITS")
+        body = b"leak test@example.com:pass1\n"
+        client = intelx.intelx(key="credits-test")
+        cap = {"paths": {"/file/read": {"Credit": 1}}}
+        intelx_helpers.configure_intelx(run.parse_args(["-t", "test@example.com", "--no-cache"]), None)
+        record = {"name": "leak.txt", "size": len(body), "systemid": "id", "bucket": "leaks.public"}
+        t = classes.target("test@example.com")
+        with local_server(body_handler(body)) as client.API_ROOT:
+            found = t.intelx_file(client, cap, record, matcher.target_matcher([t.target]))
+            self.assertEqual(found, [("INTELX.IO", "leak.txt | Line: 0 - leak test@example.com:pass1")])
+            self.assertEqual(t.intelx_file(client, cap, record, matcher.target_matcher([t.target])), [])
+        client.API_KEY = "unlimited-test"
+        self.assertTrue(intelx_helpers.take_file_credit(client, {"paths": {}}))
+
+    def test_016_intelx_file_store(self):
+        """intelx.io files downloaded once and scanned once for all targets"""
+        print_test_banner("INTELX FILE STORE")
+        store_dir = os.path.join(self.temp_dir, "intelx")
+        api_keys = {"intelx_cache_dir": store_dir, "intelx_cache_size": "0.0001"}
+        user_args = run.parse_args(["-t", "test@example.com"])
+        downloads = []
+
+        def download():
+            downloads.append(1)
+            return iter([b"a@example.com:pass1\nb@exam", b"ple.com:pass2\na@example.com:pass3\n"])
+
+        intelx_helpers.configure_intelx(user_args, api_keys)
+        intelx_helpers.add_intelx_targets(["a@example.com", "b@example.com"])
+        self.assertEqual([cnt for cnt, _ in intelx_helpers.search_stored_file("sid1", "a@example.com", download)], [0, 2])
+        self.assertEqual(intelx_helpers.search_stored_file("sid1", "b@example.com", download), [(1, b"b@example.com:pass2\n")])
+        self.assertEqual(intelx_helpers.search_stored_file("sid1", "c@example.com", download), [])
+        self.assertEqual(len(downloads), 1)
+        self.assertEqual(os.stat(store_dir).st_mode & 0o777, 0o700)
+        self.assertEqual(os.stat(intelx_helpers._store.path("sid1")).st_mode & 0o777, 0o600)
+        # Next run reuses the stored file
+        intelx_helpers.configure_intelx(user_args, api_keys)
+        self.assertEqual(len(intelx_helpers.search_stored_file("sid1", "a@example.com", download)), 2)
+        self.assertEqual(len(downloads), 1)
+        # Store holds about 100 bytes, the least recently used file is evicted
+        intelx_helpers.search_stored_file("sid2", "a@example.com", download)
+        self.assertEqual(len(os.listdir(store_dir)), 1)
+        self.assertTrue(os.path.exists(intelx_helpers._store.path("sid2")))
+        intelx_helpers.configure_intelx(run.parse_args(["-t", "test@example.com", "--no-cache"]), None)
+
+    def test_017_intelx_client(self):
+        """intelx.io searches polled together with cached capabilities"""
+        print_test_banner("INTELX CLIENT")
+        calls = []
+        polls = {}
+
+        class api_handler(quiet_handler):
+            def reply(self, data):
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(json.dumps(data).encode())
+
+            def do_GET(self):
+                calls.append(self.path.split("?")[0])
+                if self.path.startswith("/authenticate/info"):
+                    self.reply({"paths": {"/intelligent/search": {"Credit": 10}}, "buckets": ["pastes", "leaks.public", "leaks", "paste", "web"]})
+                elif self.path.startswith("/intelligent/search/result"):
+                    search_id = self.path.split("id=")[1].split("&")[0]
+                    polls[search_id] = polls.get(search_id, 0) + 1
+                    if polls[search_id] == 1:
+                        self.reply({"status": 3, "records": []})
+                    else:
+                        self.reply({"status": 1, "records": [{"name": search_id, "bucket": "pastes", "size": 1, "storageid": "sid"}]})
+
+            def do_POST(self):
+                term = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["term"]
+                if term == "bad":
+                    self.send_response(401)
+                    self.end_headers()
+                    return
+                self.reply({"id": "search-" + term})
+
+        intelx_helpers.configure_intelx(run.parse_args(["-t", "test@example.com", "--no-cache"]), None)
+        client = intelx_helpers.get_intelx_client("client-test", "test")
+        with local_server(api_handler) as client.api.API_ROOT:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                searches = list(executor.map(lambda t: intelx_helpers.intelx_getsearch(t, client, 10), ["a@example.com", "b@example.com"]))
+            with self.assertRaises(intelx.intelx_error):
+                client.search("bad")
+        self.assertEqual([[r["name"] for r in s["records"]] for s in searches], [["search-a@example.com"], ["search-b@example.com"]])
+        self.assertEqual(calls.count("/authenticate/info"), 1)
+        self.assertEqual(client.buckets(), ["pastes", "leaks.public"])
+        self.assertEqual(intelx.next_poll_delay(intelx.POLL_MAX, False), intelx.POLL_MAX)
+        self.assertEqual(intelx.next_poll_delay(2, True), intelx.POLL_MIN)
+
+    def test_018_url_harvest(self):
+        """Emails harvested from pages fetched concurrently, scanned while they download"""
+        print_test_banner("URL HARVEST")
+        agents = []
+        pages = {
+            "/a": [b"<p>first@example.com, sec", b"ond@example.com</p>"],
+            "/b": [b"first@example.com third@example.com"],
+            "/big": [b"x" * 64 + b" big@example.com"],
+        }
+
+        class page_handler(quiet_handler):
+            def do_GET(self):
+                agents.append(self.headers["User-Agent"])
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.end_headers()
+                for chunk in pages[self.path]:
+                    self.wfile.write(chunk)
+                    self.wfile.flush()
+
+        with local_server(page_handler) as root:
+            emails = url.target_urls(run.parse_args(["-u", root + "/a", root + "/b", root + "/a"]))
+            with contextlib.ExitStack() as stack:
+                stack.callback(setattr, url, "URL_MAX_SIZE", url.URL_MAX_SIZE)
+                url.URL_MAX_SIZE = 32
+                capped = url.worker_url(root + "/big")
+        self.assertEqual(emails, ["first@example.com", "second@example.com", "third@example.com"])
+        self.assertIsNone(capped)
+        self.assertEqual(len(agents), 3)
+        self.assertTrue(all(a == url.BROWSER_UA for a in agents))
+        chunks = [b"a@exa", b"mple.com b@", b"example.com"]
+        self.assertEqual(list(url.scan_emails(chunks)), ["a@example.com", "b@example.com"])